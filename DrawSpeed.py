@@ -5,6 +5,8 @@ Choose what you want too see.
     ie : download, uploads or both (more options to follow)
 Allows for filtering on any attribute in json data
     ie : ssid, Provider or ip_address
+Can also draw a day of week by hour of day heatmap (median and 10th percentile) to find peak hour congestion
+Can compare networks by grouping samples on ssid, Provider, ip_address or probe, on one chart or small multiples
 Requirements
     plotly
     matplotlib
@@ -13,6 +15,7 @@ __author__ = "Paul Pfeffer"
 
 import re
 import datetime
+import hashlib
 import itertools
 import plotly
 
@@ -20,6 +23,23 @@ import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import numpy as np
 
+import SpeedCache
+import SpeedStore
+
+# Bits per second in a Mbit/s, the unit speeds are drawn in
+MBIT = 1e6
+
+# How OutageDetector intervals are shaded
+INTERVAL_COLORS = {"outage": "red", "sla": "orange", "cusum": "purple"}
+INTERVAL_LABELS = {"outage": "Outage", "sla": "SLA breach", "cusum": "Degraded"}
+
+DAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def parse_timestamp(timestamp):
+    """Turn a "%Y-%m-%d %H:%M:%S" timestamp into a datetime."""
+    return datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+
 
 def filter_data(data, filter_key, filter_value):
     """
@@ -32,7 +52,7 @@ def filter_data(data, filter_key, filter_value):
     for date, data in data.iteritems():
         keep_data = False
         for key, val in data.iteritems():
-            if key.strip() == filter_key and val.strip() == filter_value:
+            if key.strip() == filter_key and u"{0}".format(val).strip() == filter_value:
                 keep_data = True
         if keep_data:
             new_data[date] = data
@@ -46,6 +66,8 @@ def parse_data(self, parsedays=True):
     @param self instance of either DrawWithPlotly or DrawWithPyPlot
     @param parsedays whether to parse days or not (default:True)
                      if False all days will be treated as the same
+    Failed tests (results with an "error" key) have no speeds and are skipped.
+    Speeds are stored in bits/s and are drawn in Mbit/s.
     """
     self.timestamps = []
     self.upload_speeds = []
@@ -55,6 +77,8 @@ def parse_data(self, parsedays=True):
     self.all_info = []
     self.uids = []
     for key, val in sorted(self.speeddata.iteritems()):
+        if "error" in val:
+            continue
         d = re.search(self.datetime_regex, key)
         self.timestamps.append(datetime.datetime(
             year=int(d.group(1)),
@@ -65,14 +89,234 @@ def parse_data(self, parsedays=True):
             second=int(d.group(6)))
         )
         self.all_info.append(val["all_info"])
-        self.upload_speeds.append(float(re.search(self.number, val["upload"]).group(1)))
-        self.download_speeds.append(float(re.search(self.number, val["download"]).group(1)))
-        self.ping_speeds.append(float(re.search(self.number, val["ping"]).group(1)))
+        self.upload_speeds.append(val["upload"] / MBIT)
+        self.download_speeds.append(val["download"] / MBIT)
+        self.ping_speeds.append(val["ping"])
         self.ssid_names.append(val["ssid"])
     if not parsedays:
         self.timestamps = [item.replace(year=2000, month=1, day=1) for item in self.timestamps]
 
 
+def parse_samples(self, samples, parsedays=True):
+    """
+    Set the same local variables as parse_data from SpeedCache samples.
+
+    @param self instance of either DrawWithPlotly or DrawWithPyPlot
+    @param samples see SpeedCache, failed tests are skipped
+    @param parsedays see parse_data (default:True)
+    """
+    samples = SpeedCache.select(samples, ~samples["error"])
+    self.timestamps = SpeedCache.datetimes(samples).astype(datetime.datetime).tolist()
+    self.upload_speeds = (samples["upload"] / MBIT).tolist()
+    self.download_speeds = (samples["download"] / MBIT).tolist()
+    self.ping_speeds = samples["ping"].tolist()
+    self.ssid_names = samples["ssid"].tolist()
+    self.all_info = samples["all_info"]
+    self.uids = []
+    if not parsedays:
+        self.timestamps = [item.replace(year=2000, month=1, day=1) for item in self.timestamps]
+
+
+def _binned_quantile(sorted_values, starts, counts, q):
+    """Linear interpolated quantile of every bin of values sorted by bin then value."""
+    pos = starts + (counts - 1) * q
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    empty = counts == 0
+    lo[empty] = 0
+    hi[empty] = 0
+    quantile = sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+    quantile[empty] = np.nan
+    return quantile
+
+
+def hour_day_profile(times, values):
+    """
+    Bin samples by day of week and hour of day.
+
+    One sort and one np.bincount over the samples, no loop over the cells.
+
+    @param times datetime64[s] array
+    @param values float array of the same length
+    @retval dictionary of 7x24 arrays (row 0 is Monday): count, median and p10 (nan where a cell is empty)
+    """
+    days = times.astype("datetime64[D]")
+    # 1970-01-01 was a Thursday
+    weekday = (days.astype(np.int64) + 3) % 7
+    hour = (times - days).astype(np.int64) // 3600
+    cell = weekday * 24 + hour
+    counts = np.bincount(cell, minlength=7 * 24)
+    if not len(values):
+        empty = np.full(7 * 24, np.nan).reshape(7, 24)
+        return {"count": counts.reshape(7, 24), "median": empty, "p10": empty.copy()}
+    order = np.lexsort((values, cell))
+    sorted_values = values[order]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return {
+        "count": counts.reshape(7, 24),
+        "median": _binned_quantile(sorted_values, starts, counts, 0.5).reshape(7, 24),
+        "p10": _binned_quantile(sorted_values, starts, counts, 0.1).reshape(7, 24)
+    }
+
+
+def load_profile(store, metric, start=None, end=None, filter_key=None, filter_value=None):
+    """
+    Get hour_day_profile of a metric, reusing a cache file next to the store while its revision is unchanged.
+
+    @param store a SpeedStore store
+    @param metric one of download, upload or ping
+    @param start see SpeedStore query (default:None)
+    @param end see SpeedStore query (default:None)
+    @param filter_key see filter_data (default:None)
+    @param filter_value see filter_data (default:None)
+    """
+    key = u"{0}|{1}|{2}|{3}|{4}".format(metric, start, end, filter_key, filter_value).encode("utf-8")
+    cache_path = store.sidecar_path("profile-{0}.npz".format(hashlib.md5(key).hexdigest()[:12]))
+    revision = store.revision()
+    try:
+        with np.load(cache_path) as cached:
+            if str(cached["revision"]) == revision:
+                return {"count": cached["count"], "median": cached["median"], "p10": cached["p10"]}
+    except (IOError, OSError, KeyError, ValueError):
+        pass
+
+    samples = SpeedCache.select_range(SpeedCache.load_samples(store), start, end)
+    if filter_key:
+        samples = SpeedCache.filter_samples(samples, filter_key, filter_value)
+    samples = SpeedCache.select(samples, ~np.isnan(samples[metric]))
+    profile = hour_day_profile(SpeedCache.datetimes(samples), samples[metric])
+    SpeedCache.write_npz(cache_path, revision=np.array(revision), **profile)
+    return profile
+
+
+def summarize(store, metric, bucket="day", start=None, end=None, filter_key=None, filter_value=None):
+    """
+    Summarize a metric per time bucket, inside sqlite when the store can (see SpeedStore.SqliteStore.aggregate).
+
+    Other stores are summarized from the cache of their samples.
+
+    @param store a SpeedStore store
+    @param metric one of download, upload or ping
+    @param bucket one of SpeedStore.SUMMARY_WIDTHS (default:day)
+    @param start see SpeedStore query (default:None)
+    @param end see SpeedStore query (default:None)
+    @param filter_key see filter_data (default:None)
+    @param filter_value see filter_data (default:None)
+    @retval list of (bucket, count, min, avg, max) tuples ordered by bucket
+    """
+    if hasattr(store, "aggregate"):
+        filters = {filter_key: filter_value} if filter_key else {}
+        return store.aggregate(metric, bucket, start, end, **filters)
+    width = SpeedStore.SUMMARY_WIDTHS[bucket]
+    samples = SpeedCache.select_range(SpeedCache.load_samples(store), start, end)
+    if filter_key:
+        samples = SpeedCache.filter_samples(samples, filter_key, filter_value)
+    samples = SpeedCache.select(samples, ~np.isnan(samples[metric]))
+    if not len(samples[metric]):
+        return []
+    # Samples are sorted by timestamp so every bucket is one run of them.
+    buckets, index, counts = np.unique(samples["timestamp"].astype("U{0}".format(width)),
+                                       return_index=True, return_counts=True)
+    values = samples[metric]
+    return list(zip(buckets.tolist(), counts.tolist(), np.minimum.reduceat(values, index).tolist(),
+                    (np.add.reduceat(values, index) / counts).tolist(), np.maximum.reduceat(values, index).tolist()))
+
+
+def format_summary(rows, unit, scale=1.0):
+    """
+    Return summarize rows as lines of a text table.
+
+    @param rows see summarize
+    @param unit unit of the metric after scaling. ie) Mbit/s
+    @param scale what values are divided by. ie) MBIT (default:1.0)
+    """
+    lines = ["{0:19} {1:>7} {2:>9} {3:>9} {4:>9}  ({5})".format("bucket", "tests", "min", "avg", "max", unit)]
+    for bucket, count, low, avg, high in rows:
+        lines.append("{0:19} {1:>7} {2:>9.2f} {3:>9.2f} {4:>9.2f}".format(
+            bucket, count, low / scale, avg / scale, high / scale))
+    return lines
+
+
+def split_groups(samples, group_key, columns=None):
+    """
+    Sort samples by a column and find where each of its values starts.
+
+    One stable sort of the column, samples keep their time order inside a group.
+
+    @param samples see SpeedCache
+    @param group_key one of SpeedCache.STRING_COLUMNS. ie) ssid
+    @param columns only keep these columns in the grouped samples (default:None, every column)
+    @retval (names, grouped samples, starts, counts), group i is grouped[starts[i]:starts[i] + counts[i]]
+    """
+    if group_key not in SpeedCache.STRING_COLUMNS:
+        raise ValueError("Cannot group by {0}. Choose from {1}".format(group_key, SpeedCache.STRING_COLUMNS))
+    column = samples[group_key]
+    order = np.argsort(column, kind="mergesort")
+    if columns is not None:
+        samples = dict((key, samples[key]) for key in columns)
+    grouped = SpeedCache.select(samples, order)
+    column = column[order]
+    if len(column):
+        starts = np.concatenate(([0], np.flatnonzero(column[1:] != column[:-1]) + 1)).astype(np.int64)
+    else:
+        starts = np.zeros(0, dtype=np.int64)
+    counts = np.diff(np.append(starts, len(column)))
+    return column[starts], grouped, starts, counts
+
+
+def group_stats(values, errors, starts, counts):
+    """
+    Summarize a metric for every group of split_groups at once.
+
+    @param values the metric of the grouped samples from split_groups, nan for failed tests
+    @param errors the error column of the grouped samples
+    @param starts see split_groups
+    @param counts see split_groups
+    @retval dictionary of arrays with one item per group: count, errors, mean, min, p10, median, p90
+            and max (nan for a group without a successful test)
+    """
+    group = np.repeat(np.arange(len(starts)), counts)
+    valid = ~np.isnan(values)
+    valid_counts = np.bincount(group, weights=valid, minlength=len(starts)).astype(np.int64)
+    # One sort by group then value like hour_day_profile, groups keep their place as they are contiguous.
+    # nan sorts last so the valid values of a group start at its start.
+    sorted_values = values[np.lexsort((values, group))]
+    sums = np.bincount(group, weights=np.where(valid, values, 0.0), minlength=len(starts))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / valid_counts
+    stats = {
+        "count": counts,
+        "errors": np.bincount(group, weights=errors, minlength=len(starts)).astype(np.int64),
+        "mean": mean,
+    }
+    for key, q in (("min", 0.0), ("p10", 0.1), ("median", 0.5), ("p90", 0.9), ("max", 1.0)):
+        stats[key] = _binned_quantile(sorted_values, starts, valid_counts, q)
+    return stats
+
+
+def group_labels(names, stats, unit):
+    """Return a legend label for every group with its median."""
+    return ["{0} (median {1:.2f} {2})".format(name or "(none)", median, unit)
+            for name, median in zip(names, stats["median"])]
+
+
+def format_group_stats(names, stats, unit):
+    """
+    Return group_stats as lines of a text table.
+
+    @param names group names from split_groups
+    @param stats see group_stats
+    @param unit unit of the metric. ie) Mbit/s
+    """
+    lines = ["{0:24} {1:>7} {2:>7} {3:>9} {4:>9} {5:>9} {6:>9}  ({7})".format(
+        "group", "tests", "failed", "mean", "p10", "median", "p90", unit)]
+    for idx, name in enumerate(names):
+        lines.append("{0:24} {1:>7} {2:>7} {3:>9.2f} {4:>9.2f} {5:>9.2f} {6:>9.2f}".format(
+            name or "(none)", stats["count"][idx], stats["errors"][idx], stats["mean"][idx],
+            stats["p10"][idx], stats["median"][idx], stats["p90"][idx]))
+    return lines
+
+
 class DrawWithPyPlot(object):
     """Draw SpeedTester data with matplotlib."""
 
@@ -85,7 +329,6 @@ class DrawWithPyPlot(object):
         super(DrawWithPyPlot, self).__init__()
         self.speeddata = speeddata
         self.datetime_regex = r"(\d\d\d\d)-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)"
-        self.number = r"(\d.+)(M|m)"
         self.mpl_fig_obj, self.ax = plt.subplots(1)
         # self.mpl_fig_obj = plt.figure()
 
@@ -96,6 +339,10 @@ class DrawWithPyPlot(object):
         self.extra_annotation = None
         # Available modes hover_view, inspect_view
         self.cur_mode = "hover_view"
+        # OutageDetector intervals to shade
+        self.intervals = []
+        # SpeedScheduler decisions to draw
+        self.schedule = []
 
     def set_data(self, data):
         """Set the data that will be graphed.
@@ -167,9 +414,11 @@ class DrawWithPyPlot(object):
         self.annotate_median()
         self.annotate_mean()
         self.annotate_running_average()
+        self.shade_intervals()
 
         # Make a legend
         plt.legend(loc='upper right')
+        self.draw_schedule()
 
         # Set up event handlers
         self.mpl_fig_obj.canvas.mpl_connect('pick_event', self.on_pick_event)
@@ -178,6 +427,69 @@ class DrawWithPyPlot(object):
         self.mpl_fig_obj.canvas.mpl_connect('motion_notify_event', self.on_hover)
         plt.show()
 
+    def draw_profile(self, profile, name, unit):
+        """
+        Draw an hour_day_profile as two heatmaps, median and 10th percentile.
+
+        @param profile see hour_day_profile, in the unit given
+        @param name name of the metric. ie) Download
+        @param unit unit of the metric. ie) Mbit/s
+        """
+        plt.close(self.mpl_fig_obj)
+        self.mpl_fig_obj, axes = plt.subplots(2, 1, sharex=True)
+        for ax, key, title in zip(axes, ("median", "p10"), ("Median", "10th percentile")):
+            image = ax.imshow(np.ma.masked_invalid(profile[key]), aspect='auto', interpolation='nearest', cmap='viridis')
+            ax.set_title("{0} {1} by hour of day".format(title, name))
+            ax.set_yticks(range(7))
+            ax.set_yticklabels(DAY_NAMES)
+            self.mpl_fig_obj.colorbar(image, ax=ax, label=unit)
+        axes[-1].set_xticks(range(24))
+        axes[-1].set_xlabel("Hour of day")
+        plt.show()
+
+    def draw_groups(self, names, times, values, starts, counts, stats, name, unit, layout="overlay"):
+        """
+        Compare the groups of split_groups on one chart or on small multiples.
+
+        @param names see split_groups
+        @param times datetime64 array of the grouped samples
+        @param values the metric of the grouped samples in unit, nan for failed tests
+        @param starts see split_groups
+        @param counts see split_groups
+        @param stats see group_stats, in unit
+        @param name name of the metric. ie) Download
+        @param unit unit of the metric. ie) Mbit/s
+        @param layout overlay draws every group on one chart, multiples draws a chart per group
+                      sharing both axes (default:overlay)
+        """
+        labels = group_labels(names, stats, unit)
+        if layout == "multiples":
+            plt.close(self.mpl_fig_obj)
+            cols = int(np.ceil(np.sqrt(len(names))))
+            rows = int(np.ceil(len(names) / float(cols)))
+            self.mpl_fig_obj, axes = plt.subplots(rows, cols, sharex=True, sharey=True, squeeze=False)
+            axes = axes.ravel()
+            for ax in axes[len(names):]:
+                ax.set_visible(False)
+        else:
+            axes = [self.ax] * len(names)
+        for idx, ax in enumerate(axes[:len(names)]):
+            part = slice(starts[idx], starts[idx] + counts[idx])
+            ax.plot(times[part], values[part], marker='.', markersize=3, linewidth=0.8, label=labels[idx])
+            if layout == "multiples":
+                ax.axhline(stats["median"][idx], linestyle='--', color='gray')
+                ax.set_title(labels[idx], fontsize='small')
+                ax.grid(True)
+        if layout == "multiples":
+            self.mpl_fig_obj.suptitle("{0} ({1}) by group".format(name, unit))
+        else:
+            self.ax.set_title("{0} by group".format(name))
+            self.ax.set_ylabel(unit)
+            self.ax.grid(True)
+            self.ax.legend(loc='upper right')
+        self.mpl_fig_obj.autofmt_xdate()
+        plt.show()
+
     def annotate_max(self):
         """Add annotation for the max point in the plot."""
         index, val = self.get_max_index_and_value(self.data["data"])
@@ -257,6 +569,29 @@ class DrawWithPyPlot(object):
             bbox=dict(boxstyle='round,pad=0.5', fc='yellow', alpha=0.5),
             arrowprops=dict(arrowstyle='fancy', connectionstyle='arc3,rad=0'))
 
+    def shade_intervals(self):
+        """Shade the OutageDetector intervals in self.intervals."""
+        labeled = set()
+        for interval in self.intervals:
+            kind = interval["kind"]
+            plt.axvspan(parse_timestamp(interval["start"]), parse_timestamp(interval["end"]),
+                        color=INTERVAL_COLORS[kind], alpha=0.2,
+                        label=None if kind in labeled else INTERVAL_LABELS[kind])
+            labeled.add(kind)
+
+    def draw_schedule(self):
+        """Draw the minutes between tests picked by SpeedScheduler on a second y axis."""
+        if not self.schedule:
+            return
+        ax2 = self.ax.twinx()
+        ax2.step([parse_timestamp(decision["start"]) for decision in self.schedule],
+                 [decision["delay"] / 60.0 for decision in self.schedule],
+                 where='post', color='gray', alpha=0.5, label="Minutes between tests")
+        ax2.set_ylabel("Minutes between tests")
+        ax2.legend(loc='upper left')
+        # Annotations and hover events work on the speed axis
+        plt.sca(self.ax)
+
     def annotate_hover_point(self, idx):
         """Highligh a point."""
         # print (self.cur_mode)
@@ -392,7 +727,10 @@ class DrawWithPlotly(object):
         super(DrawWithPlotly, self).__init__()
         self.speeddata = speeddata
         self.datetime_regex = r"(\d\d\d\d)-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)"
-        self.number = r"(\d.+)(M|m)"
+        # OutageDetector intervals to shade
+        self.intervals = []
+        # SpeedScheduler decisions to draw
+        self.schedule = []
 
     def get_template_trace(self, graph):
         """
@@ -476,13 +814,106 @@ class DrawWithPlotly(object):
                 bgcolor='#E2E2E2',
                 bordercolor='#FFFFFF',
                 borderwidth=2
-            )
+            ),
+            shapes=[
+                dict(
+                    type='rect',
+                    xref='x',
+                    yref='paper',
+                    x0=interval["start"],
+                    x1=interval["end"],
+                    y0=0,
+                    y1=1,
+                    fillcolor=INTERVAL_COLORS[interval["kind"]],
+                    opacity=0.2,
+                    line=dict(width=0)
+                ) for interval in self.intervals
+            ]
         )
 
     def draw_data(self):
         """Call to set up layout and plotly plot to make html page."""
         self.setup_layout()
-        fig = plotly.graph_objs.Figure(data=self.data, layout=self.layout)
+        data = list(self.data)
+        if self.schedule:
+            self.layout.update(yaxis2=dict(
+                title='Minutes between tests',
+                overlaying='y',
+                side='right',
+                showgrid=False
+            ))
+            data.append(plotly.graph_objs.Scatter(
+                x=[decision["start"] for decision in self.schedule],
+                y=[decision["delay"] / 60.0 for decision in self.schedule],
+                text=[decision["reason"] for decision in self.schedule],
+                name="Minutes between tests",
+                mode='lines',
+                line=dict(shape='hv', color='gray'),
+                opacity=0.5,
+                yaxis='y2'
+            ))
+        fig = plotly.graph_objs.Figure(data=data, layout=self.layout)
+        plotly.offline.plot(fig, filename='speedresults.html')
+
+    def draw_groups(self, names, timestamps, values, starts, counts, stats, name, unit, layout="overlay"):
+        """
+        Compare the groups of split_groups on one chart or on small multiples stacked on a shared time axis.
+
+        @param timestamps "%Y-%m-%d %H:%M:%S" array of the grouped samples
+        The other parameters are the same as DrawWithPyPlot.draw_groups.
+        """
+        labels = group_labels(names, stats, unit)
+        layout_args = dict(title="{0} by group".format(name), xaxis=dict(title='Date Time'))
+        data = []
+        height = 1.0 / max(1, len(names))
+        for idx, label in enumerate(labels):
+            part = slice(starts[idx], starts[idx] + counts[idx])
+            trace = dict(
+                x=timestamps[part].tolist(),
+                y=[None if np.isnan(val) else val for val in values[part]],
+                name=label,
+                mode='lines+markers',
+                marker=dict(size=4),
+                line=dict(width=1)
+            )
+            if layout == "multiples":
+                axis = "yaxis" if idx == 0 else "yaxis{0}".format(idx + 1)
+                trace["yaxis"] = "y" if idx == 0 else "y{0}".format(idx + 1)
+                layout_args[axis] = dict(title=names[idx] or "(none)", domain=[idx * height, (idx + 0.9) * height])
+            data.append(plotly.graph_objs.Scatter(**trace))
+        if layout == "multiples":
+            layout_args["height"] = max(400, 200 * len(names))
+        else:
+            layout_args["yaxis"] = dict(title=unit)
+        fig = plotly.graph_objs.Figure(data=data, layout=plotly.graph_objs.Layout(**layout_args))
+        plotly.offline.plot(fig, filename='speedresults.html')
+
+    def draw_profile(self, profile, name, unit):
+        """
+        Draw an hour_day_profile as a heatmap of the median with the 10th percentile on hover.
+
+        @param profile see hour_day_profile, in the unit given
+        @param name name of the metric. ie) Download
+        @param unit unit of the metric. ie) Mbit/s
+        """
+        text = [["Median : {0:.2f} {unit}<br>10th percentile : {1:.2f} {unit}<br>Samples : {2}".format(
+                    median, p10, count, unit=unit)
+                 for median, p10, count in zip(*row)]
+                for row in zip(profile["median"], profile["p10"], profile["count"])]
+        trace = plotly.graph_objs.Heatmap(
+            z=[[None if np.isnan(val) else val for val in row] for row in profile["median"]],
+            x=list(range(24)),
+            y=DAY_NAMES,
+            text=text,
+            hoverinfo='x+y+text',
+            colorbar=dict(title=unit)
+        )
+        layout = plotly.graph_objs.Layout(
+            title="Median {0} by hour of day".format(name),
+            xaxis=dict(title='Hour of day', dtick=1),
+            yaxis=dict(autorange='reversed')
+        )
+        fig = plotly.graph_objs.Figure(data=[trace], layout=layout)
         plotly.offline.plot(fig, filename='speedresults.html')
 
 
@@ -490,10 +921,9 @@ def main():
     """Example of how to use the classes."""
 
     # The data for the classes is the same
-    import json
-    results_file = "speedresults.json"
-    with open(results_file) as f:
-        results = json.load(f)
+    import SpeedStore
+    store = SpeedStore.open_store("speedresults.json")
+    results = dict(store.load())
 
     # # Using the DrawWithPlotly Class
     # d_speed = DrawWithPlotly(results)
@@ -506,6 +936,8 @@ def main():
     d_speed = DrawWithPyPlot(results)
     # d_speed.speeddata = filter_data(d_speed.speeddata, "ssid", "ssid_name")
     parse_data(d_speed, parsedays=True)
+    # or let SpeedCache keep the parsed results next to the store so drawing again is instant
+    # parse_samples(d_speed, SpeedCache.load_samples(store), parsedays=True)
     # Here you can set up what data you want to graph
     d_speed.set_data({"name": "Download", "unit": "Mbit/s", "data": d_speed.download_speeds})
     # d_speed.set_data({"name": "Upload", "unit": "Mbit/s", "data": d_speed.upload_speeds})
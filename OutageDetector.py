@@ -0,0 +1,450 @@
+"""
+Find the times your internet was down or worse than usual.
+
+Detection runs two ways over the same rules:
+    online  DetectionEngine.feed is called with every new result and does O(1) work per sample.
+    batch   detect_history runs vectorized over a whole history with numpy.
+Both produce the same interval records:
+    {
+        "kind": "outage" | "sla" | "cusum",
+        "metric": "download" | "upload" | "ping" | None,
+        "start": "%Y-%m-%d %H:%M:%S",
+        "end": "%Y-%m-%d %H:%M:%S" (first good sample after the interval or the last sample seen),
+        "detail": a short description
+    }
+
+Rules
+    outage  a test that failed (its result has an "error" key)
+    sla     a metric breached a fixed limit (ie download below 20 Mbit/s)
+    cusum   a one sided CUSUM change point detector flagged a sustained drop in speed
+            (or rise in ping) relative to a slowly moving baseline, scaled by the usual noise
+"""
+__author__ = "Paul Pfeffer"
+
+import collections
+
+import numpy as np
+
+import SpeedCache
+
+# Direction of "bad" for each metric. Speeds are bad when low, ping when high.
+BAD_WHEN = {"download": "below", "upload": "below", "ping": "above"}
+
+
+def metric_value(result, metric):
+    """
+    Return a metric of a result as a float or None when it is missing.
+
+    @param result a result dictionary
+    @param metric one of download, upload or ping
+    """
+    value = result.get(metric)
+    return None if value is None else float(value)
+
+
+def _interval(kind, metric, start, end, detail):
+    """Build an interval record."""
+    return {"kind": kind, "metric": metric, "start": start, "end": end, "detail": detail}
+
+
+class OutageRule(object):
+    """Turn failed tests into outage intervals."""
+
+    def __init__(self):
+        """Initialize OutageRule."""
+        super(OutageRule, self).__init__()
+        self.start = None
+        self.failures = 0
+        self.last_timestamp = None
+
+    def feed(self, timestamp, result):
+        """
+        Look at one result.
+
+        @retval a closed interval or None
+        """
+        self.last_timestamp = timestamp
+        if "error" in result:
+            if self.start is None:
+                self.start = timestamp
+            self.failures += 1
+            return None
+        if self.start is not None:
+            interval = _interval("outage", None, self.start, timestamp,
+                                 "{0} failed test(s)".format(self.failures))
+            self.start = None
+            self.failures = 0
+            return interval
+        return None
+
+    def open_interval(self):
+        """Return the interval still in progress or None, it ends at the last result seen."""
+        if self.start is None:
+            return None
+        return _interval("outage", None, self.start, self.last_timestamp,
+                         "{0} failed test(s), ongoing".format(self.failures))
+
+    @staticmethod
+    def detect(timestamps, errors):
+        """
+        Vectorized version of feed over a whole history.
+
+        @param timestamps array of timestamp strings
+        @param errors boolean array, True where the test failed
+        """
+        starts, ends = _runs(errors)
+        counts = ends - starts
+        return [_interval("outage", None, str(timestamps[s]), str(timestamps[min(e, len(timestamps) - 1)]),
+                          "{0} failed test(s){1}".format(c, ", ongoing" if e == len(timestamps) else ""))
+                for s, e, c in zip(starts, ends, counts)]
+
+
+class ThresholdRule(object):
+    """Flag the time a metric spends past a fixed limit."""
+
+    def __init__(self, metric, limit):
+        """
+        Initialize ThresholdRule.
+
+        @param metric one of download, upload or ping
+        @param limit the SLA value in the unit results are stored in (bits/s or ms)
+        """
+        super(ThresholdRule, self).__init__()
+        self.metric = metric
+        self.limit = limit
+        self.below = BAD_WHEN[metric] == "below"
+        self.start = None
+        self.worst = None
+        self.last_timestamp = None
+
+    def _detail(self):
+        """Describe the breach."""
+        return "{0} {1} {2} (worst {3})".format(self.metric, "below" if self.below else "above", self.limit, self.worst)
+
+    def feed(self, timestamp, value):
+        """
+        Look at one value of the metric.
+
+        @retval a closed interval or None
+        """
+        self.last_timestamp = timestamp
+        breached = value < self.limit if self.below else value > self.limit
+        if breached:
+            if self.start is None:
+                self.start = timestamp
+                self.worst = value
+            self.worst = min(self.worst, value) if self.below else max(self.worst, value)
+            return None
+        if self.start is not None:
+            interval = _interval("sla", self.metric, self.start, timestamp, self._detail())
+            self.start = None
+            return interval
+        return None
+
+    def open_interval(self):
+        """Return the interval still in progress or None, it ends at the last value seen like in detect."""
+        if self.start is None:
+            return None
+        return _interval("sla", self.metric, self.start, self.last_timestamp, self._detail() + ", ongoing")
+
+    def detect(self, timestamps, values):
+        """
+        Vectorized version of feed over a whole history.
+
+        @param timestamps array of timestamp strings
+        @param values float array of the metric
+        """
+        breached = values < self.limit if self.below else values > self.limit
+        starts, ends = _runs(breached)
+        intervals = []
+        for s, e in zip(starts, ends):
+            self.worst = values[s:e].min() if self.below else values[s:e].max()
+            detail = self._detail() + (", ongoing" if e == len(values) else "")
+            intervals.append(_interval("sla", self.metric, str(timestamps[s]), str(timestamps[min(e, len(values) - 1)]),
+                                       detail))
+        self.worst = None
+        return intervals
+
+
+class CusumRule(object):
+    """
+    One sided CUSUM over the deviation from a slowly moving baseline, in units of the usual noise.
+
+    Samples are grouped in blocks of `block`. The baseline is the median of the means of the last
+    `window` blocks and the noise is the root mean of their variances. The median keeps a bad stretch
+    from moving the baseline for a while, a change that lasts longer than half the window becomes
+    the new normal.
+
+    For every sample the deviation x is how many noise units worse than the baseline the value is,
+    capped at clip so a single spike cannot raise an alarm. The statistic S = max(0, S + x - slack)
+    grows while the link is consistently worse than usual and an interval is reported once S passes
+    threshold. The interval starts where S last left zero (the estimated change point) and ends at
+    the sample after S peaked, so the time S takes to decay back to zero is not shaded.
+
+    S is computed as C - min(0, min(C)) with C the running sum of x - slack, online and in detect,
+    so both take exactly the same decisions.
+    """
+
+    def __init__(self, metric, slack=1.0, threshold=8.0, clip=3.0, block=10, window=30, warmup=3,
+                 min_noise=0.05):
+        """
+        Initialize CusumRule.
+
+        @param metric one of download, upload or ping
+        @param slack deviation tolerated without growing S, in noise units (default:1.0)
+        @param threshold value of S that raises an alarm (default:8.0)
+        @param clip largest deviation a single sample counts for, in noise units (default:3.0)
+        @param block number of samples summarized together (default:10)
+        @param window number of blocks the baseline and noise are taken over (default:30)
+        @param warmup number of blocks needed before detection starts (default:3)
+        @param min_noise smallest noise as a fraction of the baseline, so a very steady link
+                         does not alarm on tiny changes (default:0.05)
+        """
+        super(CusumRule, self).__init__()
+        self.metric = metric
+        self.slack = slack
+        self.threshold = threshold
+        self.clip = clip
+        self.block = block
+        self.window = window
+        self.warmup = warmup
+        self.min_noise = min_noise
+        self.sign = 1.0 if BAD_WHEN[metric] == "below" else -1.0
+        self.values = []
+        self.means = collections.deque(maxlen=window)
+        self.variances = collections.deque(maxlen=window)
+        self.baseline = None
+        self.noise = None
+        self.c = 0.0
+        self.c_min = 0.0
+        self.s = 0.0
+        self.peak = 0.0
+        self.start = None
+        self.start_baseline = None
+        self.recovered = None
+        self.last_timestamp = None
+
+    def _detail(self, baseline, peak):
+        """Describe the change."""
+        return "{0} worse than baseline {1:.2f} (cusum peak {2:.2f})".format(self.metric, baseline, peak)
+
+    def _noise(self, baseline, variance):
+        """Return the noise from the mean variance of the blocks, at least min_noise of the baseline."""
+        return max(float(np.sqrt(variance)), self.min_noise * abs(baseline))
+
+    def feed(self, timestamp, value):
+        """
+        Look at one value of the metric.
+
+        @retval a closed interval or None
+        """
+        self.last_timestamp = timestamp
+        interval = None
+        if self.baseline is not None:
+            x = self.sign * (self.baseline - value) / self.noise if self.noise else 0.0
+            if self.s == 0.0:
+                self.start = timestamp
+                self.start_baseline = self.baseline
+                self.peak = 0.0
+            elif self.recovered is None:
+                self.recovered = timestamp
+            self.c += min(x, self.clip) - self.slack
+            self.c_min = min(self.c_min, self.c)
+            self.s = self.c - self.c_min
+            if self.s > self.peak:
+                self.peak = self.s
+                self.recovered = None
+            if self.s == 0.0 and self.peak > self.threshold:
+                interval = _interval("cusum", self.metric, self.start, self.recovered,
+                                     self._detail(self.start_baseline, self.peak))
+                self.peak = 0.0
+        self.values.append(value)
+        if len(self.values) == self.block:
+            values = np.array(self.values)
+            self.means.append(values.mean())
+            self.variances.append(values.var(ddof=1))
+            self.values = []
+            if len(self.means) >= self.warmup:
+                self.baseline = float(np.median(self.means))
+                self.noise = self._noise(self.baseline, np.mean(self.variances))
+        return interval
+
+    def open_interval(self):
+        """Return the interval still in progress or None."""
+        if self.s == 0.0 or self.peak <= self.threshold:
+            return None
+        return _interval("cusum", self.metric, self.start, self.recovered or self.last_timestamp,
+                         self._detail(self.start_baseline, self.peak) + ", ongoing")
+
+    def _references(self, values):
+        """
+        Return the baseline and noise of every block from warmup on, as feed finds them.
+
+        @param values float array of the metric, longer than warmup blocks
+        @retval (baseline, noise) float arrays with one entry per block
+        """
+        full = len(values) // self.block
+        blocks = values[:full * self.block].reshape(full, self.block)
+        means = blocks.mean(axis=1)
+        variances = blocks.var(axis=1, ddof=1)
+        last = (len(values) - 1) // self.block
+        baseline = np.empty(last + 1 - self.warmup)
+        variance = np.empty(last + 1 - self.warmup)
+        # Blocks with less than a full window before them, then a sliding window over the rest
+        for j in range(self.warmup, min(self.window, last) + 1):
+            baseline[j - self.warmup] = np.median(means[:j])
+            variance[j - self.warmup] = np.mean(variances[:j])
+        if last > self.window:
+            count = last - self.window
+            for column, target in ((means, baseline), (variances, variance)):
+                windows = np.lib.stride_tricks.as_strided(column[1:], (count, self.window), column.strides * 2)
+                reduce = np.median if column is means else np.mean
+                target[self.window + 1 - self.warmup:] = reduce(windows, axis=1)
+        noise = np.maximum(np.sqrt(variance), self.min_noise * np.abs(baseline))
+        return baseline, noise
+
+    def detect(self, timestamps, values):
+        """
+        Vectorized version of feed over a whole history.
+
+        @param timestamps array of timestamp strings
+        @param values float array of the metric
+        """
+        first = self.warmup * self.block
+        if len(values) <= first:
+            return []
+        baseline, noise = self._references(values)
+        baseline = np.repeat(baseline, self.block)[:len(values) - first]
+        noise = np.repeat(noise, self.block)[:len(values) - first]
+        timestamps = timestamps[first:]
+        values = values[first:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = np.where(noise > 0.0, self.sign * (baseline - values) / noise, 0.0)
+        c = np.cumsum(np.minimum(x, self.clip) - self.slack)
+        s = c - np.minimum.accumulate(np.minimum(c, 0.0))
+        starts, ends = _runs(s > 0.0)
+        if not len(starts):
+            return []
+        peaks = np.maximum.reduceat(s, starts)
+        intervals = []
+        for start, end, peak in zip(starts, ends, peaks):
+            if peak <= self.threshold:
+                continue
+            recovered = start + np.argmax(s[start:end]) + 1
+            detail = self._detail(baseline[start], peak) + (", ongoing" if end == len(values) else "")
+            intervals.append(_interval("cusum", self.metric, str(timestamps[start]),
+                                       str(timestamps[min(recovered, len(values) - 1)]), detail))
+        return intervals
+
+
+def _runs(mask):
+    """
+    Find the runs of True in a boolean array.
+
+    @retval (starts, ends) index arrays, each run is mask[start:end]
+    """
+    edges = np.diff(np.concatenate(([0], np.asarray(mask, dtype=np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+def default_rules(sla=None):
+    """
+    Return the rules used by runner.py.
+
+    @param sla optional dictionary of metric to limit. ie) {"download": 20e6}
+    """
+    rules = [CusumRule(metric) for metric in ("download", "upload", "ping")]
+    for metric, limit in sorted((sla or {}).items()):
+        rules.append(ThresholdRule(metric, limit))
+    return rules
+
+
+class DetectionEngine(object):
+    """Feed results one at a time and get back closed intervals."""
+
+    def __init__(self, rules=None):
+        """
+        Initialize DetectionEngine.
+
+        @param rules list of ThresholdRule and CusumRule (default:default_rules())
+        """
+        super(DetectionEngine, self).__init__()
+        self.rules = default_rules() if rules is None else rules
+        self.outages = OutageRule()
+
+    def feed(self, timestamp, result):
+        """
+        Look at one result.
+
+        @param timestamp "%Y-%m-%d %H:%M:%S"
+        @param result a result dictionary
+        @retval list of intervals that just closed
+        """
+        closed = []
+        interval = self.outages.feed(timestamp, result)
+        if interval:
+            closed.append(interval)
+        if "error" in result:
+            return closed
+        for rule in self.rules:
+            value = metric_value(result, rule.metric)
+            if value is None:
+                continue
+            interval = rule.feed(timestamp, value)
+            if interval:
+                closed.append(interval)
+        return closed
+
+    def history_size(self):
+        """Return how many earlier results fill the memory of every rule, a CusumRule keeps window * block."""
+        return max([1] + [rule.window * rule.block for rule in self.rules if isinstance(rule, CusumRule)])
+
+    def prime(self, pairs):
+        """
+        Feed earlier results so detection picks up where the last run stopped instead of warming up again.
+
+        Intervals that close among them are not returned, the run that measured them reported them.
+        An interval still open at the end goes on with the next result.
+
+        @param pairs the latest results in the store as sorted (timestamp, result) pairs, see SpeedStore tail
+        """
+        for timestamp, result in pairs:
+            self.feed(timestamp, result)
+
+    def open_intervals(self):
+        """Return the intervals still in progress."""
+        intervals = [rule.open_interval() for rule in [self.outages] + self.rules]
+        return [interval for interval in intervals if interval]
+
+
+def detect_history(results, rules=None):
+    """
+    Run every rule over a whole history at once.
+
+    @param results dictionary of timestamp to result (the store format)
+    @param rules see DetectionEngine (default:default_rules())
+    @retval list of intervals ordered by start
+    """
+    return detect_samples(SpeedCache.build_samples(sorted(results.items())), rules)
+
+
+def detect_samples(samples, rules=None):
+    """
+    Run every rule over SpeedCache samples at once.
+
+    @param samples see SpeedCache
+    @param rules see DetectionEngine (default:default_rules())
+    @retval list of intervals ordered by start
+    """
+    rules = default_rules() if rules is None else rules
+    timestamps = samples["timestamp"]
+    if not len(timestamps):
+        return []
+    errors = samples["error"]
+    intervals = OutageRule.detect(timestamps, errors)
+    good = timestamps[~errors]
+    for rule in rules:
+        values = samples[rule.metric][~errors]
+        present = ~np.isnan(values)
+        intervals.extend(rule.detect(good[present], values[present]))
+    return sorted(intervals, key=lambda interval: interval["start"])
@@ -0,0 +1,112 @@
+"""
+Control a running runner.py over a unix domain socket.
+
+The protocol is one json object per line. A client sends {"command": "..."} and gets back one reply.
+    stop        finish or cancel the current test, flush results and exit
+    test        run a test now instead of waiting for the next one
+    reload      re-read the runner's -configfile
+    status      what the runner is doing
+
+ie) send_command("/tmp/runner.sock", "status")
+"""
+__author__ = "Paul Pfeffer"
+
+import json
+import os
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:  # python 2
+    import SocketServer as socketserver
+
+COMMANDS = ["stop", "test", "reload", "status"]
+SUPPORTED = hasattr(socket, "AF_UNIX")  # no unix sockets on Windows, signals still stop the runner
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    """Answer every command line sent on one connection."""
+
+    def handle(self):
+        """Read commands until the client hangs up."""
+        for line in self.rfile:
+            try:
+                command = json.loads(line.decode("utf-8"))["command"]
+                if command not in COMMANDS:
+                    raise ValueError("Unknown command {0}".format(command))
+                reply = self.server.callback(command)
+            except (ValueError, KeyError, TypeError) as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write((json.dumps(reply) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+if SUPPORTED:
+    class _ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """Unix socket server that hands commands to a callback."""
+        daemon_threads = True
+
+
+class ControlServer(object):
+    """Serve control commands in a background thread."""
+
+    def __init__(self, socket_path, callback, logger=None):
+        """
+        Initialize ControlServer.
+
+        @param socket_path where to create the unix socket, an old socket left there is replaced
+        @param callback called with each command, returns a json serializable reply dictionary
+        @param logger optional logger
+        """
+        super(ControlServer, self).__init__()
+        if not SUPPORTED:
+            raise NotImplementedError("Unix sockets are not available on this platform")
+        self.socket_path = socket_path
+        self.logger = logger
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = _ControlServer(socket_path, _ControlHandler)
+        self.server.callback = callback
+        self.thread = threading.Thread(target=self.server.serve_forever, name="runner-control")
+        self.thread.daemon = True
+
+    def start(self):
+        """Start answering commands."""
+        self.thread.start()
+        if self.logger:
+            self.logger.info("Listening for commands on {0}".format(self.socket_path))
+
+    def close(self):
+        """Stop answering commands and remove the socket."""
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def send_command(socket_path, command, timeout=5.0):
+    """
+    Send one command to a runner and return its reply.
+
+    @param socket_path the runner's -socket
+    @param command one of COMMANDS
+    @param timeout seconds to wait for the reply (default:5.0)
+    @retval reply dictionary
+    """
+    if not SUPPORTED:
+        raise NotImplementedError("Unix sockets are not available on this platform")
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps({"command": command}) + "\n").encode("utf-8"))
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    finally:
+        client.close()
+    return json.loads(reply.decode("utf-8"))
@@ -0,0 +1,296 @@
+"""
+Keep parsed results as numpy arrays in a .npz file next to the store.
+
+Drawing reads the cache instead of parsing the whole store again:
+    unchanged store     the cache is used as is (a stat for json, one query for sqlite)
+    appended results    only the new results are parsed and added to the cache
+    anything else       the cache is rebuilt from the whole store
+See changes_since in SpeedStore for how each store decides.
+
+Samples are a dictionary of equal length arrays sorted by timestamp:
+    timestamp                       "%Y-%m-%d %H:%M:%S" strings
+    error                           True for failed tests
+    download, upload, ping          floats in bits/s and ms (nan for failed tests)
+    ssid, Provider, ip_address      strings ("" when missing)
+    probe                           name of the probe a collector got the result from ("" when missing)
+    all_info                        a TextColumn of the raw speedtest output
+"""
+__author__ = "Paul Pfeffer"
+
+import glob
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+# Bump when the layout of the cache changes so old caches are rebuilt.
+CACHE_VERSION = 2
+
+# os.rename will not overwrite an existing file on windows, os.replace (python 3.3+) does.
+_replace = getattr(os, "replace", os.rename)
+
+CACHE_NAME = "samples.npz"
+
+# Seconds after which a temporary file is taken to be left over by a process that died while writing it.
+TMP_MAX_AGE = 3600
+
+FLOAT_COLUMNS = ["download", "upload", "ping"]
+STRING_COLUMNS = ["ssid", "Provider", "ip_address", "probe"]
+TEXT_COLUMNS = ["all_info"]
+
+
+class TextColumn(object):
+    """
+    Strings kept in one utf-8 buffer.
+
+    Long texts like all_info would take (longest text * 4 bytes) per sample as a numpy string array.
+    Indexing with an integer returns the string, indexing with a mask or index array returns a TextColumn.
+    """
+
+    def __init__(self, blob, starts, ends):
+        """
+        Initialize TextColumn.
+
+        @param blob uint8 array of utf-8 bytes
+        @param starts int64 array of where each string starts in blob
+        @param ends int64 array of where each string ends in blob
+        """
+        super(TextColumn, self).__init__()
+        self.blob = blob
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_strings(cls, strings):
+        """Build a TextColumn from a list of strings."""
+        encoded = [string.encode("utf-8") for string in strings]
+        lengths = np.array([len(item) for item in encoded], dtype=np.int64)
+        ends = np.cumsum(lengths)
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(blob, ends - lengths, ends)
+
+    def __len__(self):
+        """Return the number of strings."""
+        return len(self.starts)
+
+    def __getitem__(self, idx):
+        """Return one string or a TextColumn of the selected strings."""
+        if isinstance(idx, (int, np.integer)):
+            return self.blob[self.starts[idx]:self.ends[idx]].tobytes().decode("utf-8")
+        return TextColumn(self.blob, self.starts[idx], self.ends[idx])
+
+    def concatenate(self, other):
+        """Return a TextColumn holding the strings of self followed by the strings of other."""
+        return TextColumn(np.concatenate((self.blob, other.blob)),
+                          np.concatenate((self.starts, other.starts + len(self.blob))),
+                          np.concatenate((self.ends, other.ends + len(self.blob))))
+
+
+def _text(value):
+    """Return value as a string, "" for None."""
+    return u"" if value is None else u"{0}".format(value)
+
+
+def build_samples(pairs):
+    """
+    Turn results into samples.
+
+    @param pairs list of (timestamp, result)
+    @retval samples dictionary sorted by timestamp
+    """
+    results = [result for _, result in pairs]
+    samples = {
+        "timestamp": np.array([timestamp[:19] for timestamp, _ in pairs], dtype="U19"),
+        "error": np.array(["error" in result for result in results], dtype=bool)
+    }
+    for column in FLOAT_COLUMNS:
+        samples[column] = np.array([result.get(column) for result in results], dtype=float)
+    for column in STRING_COLUMNS:
+        samples[column] = np.array([_text(result.get(column)) for result in results], dtype=np.str_)
+    for column in TEXT_COLUMNS:
+        samples[column] = TextColumn.from_strings([_text(result.get(column)) for result in results])
+    order = np.argsort(samples["timestamp"], kind="mergesort")
+    if np.any(order != np.arange(len(order))):
+        samples = select(samples, order)
+    return samples
+
+
+def select(samples, idx):
+    """
+    Return the samples picked by idx.
+
+    @param samples samples dictionary
+    @param idx boolean mask or index array
+    """
+    return dict((key, column[idx]) for key, column in samples.items())
+
+
+def concatenate(samples, more):
+    """Return samples followed by more, sorted by timestamp."""
+    combined = {}
+    for key, column in samples.items():
+        if isinstance(column, TextColumn):
+            combined[key] = column.concatenate(more[key])
+        else:
+            combined[key] = np.concatenate((column, more[key]))
+    if len(samples["timestamp"]) and len(more["timestamp"]) and more["timestamp"][0] < samples["timestamp"][-1]:
+        combined = select(combined, np.argsort(combined["timestamp"], kind="mergesort"))
+    return combined
+
+
+def select_range(samples, start=None, end=None):
+    """
+    Return the samples between start and end (inclusive).
+
+    @param start "%Y-%m-%d %H:%M:%S" or a prefix of it (default:None)
+    @param end "%Y-%m-%d %H:%M:%S" or a prefix of it (default:None)
+    """
+    mask = np.ones(len(samples["timestamp"]), dtype=bool)
+    if start:
+        mask &= samples["timestamp"] >= start
+    if end:
+        mask &= samples["timestamp"].astype("U{0}".format(len(end))) <= end
+    return samples if mask.all() else select(samples, mask)
+
+
+def filter_samples(samples, filter_key, filter_value):
+    """
+    Return the samples where filter_key equals filter_value, like DrawSpeed.filter_data.
+
+    @param filter_key a column of samples. ie) ssid or Provider
+    @param filter_value the value to keep
+    """
+    if filter_key not in samples or filter_key in TEXT_COLUMNS:
+        raise ValueError("Cannot filter on {0}".format(filter_key))
+    column = samples[filter_key]
+    if column.dtype.kind == "f":
+        return select(samples, column == float(filter_value))
+    return select(samples, np.char.strip(column) == filter_value.strip())
+
+
+def datetimes(samples):
+    """Return the timestamps of samples as a datetime64[s] array."""
+    return samples["timestamp"].astype("datetime64[s]")
+
+
+def save(path, samples, token):
+    """
+    Atomically write samples and the store token they were built from.
+
+    @param path cache file path
+    @param samples samples dictionary
+    @param token token from the store's changes_since
+    """
+    arrays = {}
+    for key, column in samples.items():
+        if isinstance(column, TextColumn):
+            arrays[key + "__blob"] = column.blob
+            arrays[key + "__starts"] = column.starts
+            arrays[key + "__ends"] = column.ends
+        else:
+            arrays[key] = column
+    write_npz(path, version=np.array(CACHE_VERSION), token=np.array(json.dumps(token)), **arrays)
+
+
+def write_npz(path, **arrays):
+    """
+    Atomically replace path with an npz file of arrays.
+
+    Each writer gets a temporary file of its own in the same directory, so processes drawing
+    the same store at once never write into each other's file.
+
+    @param path destination path
+    @param arrays arrays to save, see numpy.savez
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        _replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def load(path):
+    """
+    Read a cache file.
+
+    @retval (samples, token) or (None, None) when there is no usable cache
+    """
+    try:
+        with np.load(path) as cached:
+            if int(cached["version"]) != CACHE_VERSION:
+                return None, None
+            token = json.loads(str(cached["token"]))
+            samples = {}
+            for key in cached.files:
+                if key in ("version", "token") or "__" in key:
+                    continue
+                samples[key] = cached[key]
+            for key in TEXT_COLUMNS:
+                samples[key] = TextColumn(cached[key + "__blob"], cached[key + "__starts"], cached[key + "__ends"])
+    except (IOError, OSError, KeyError, ValueError):
+        return None, None
+    return samples, token
+
+
+def evict_stale(store):
+    """
+    Delete cache files next to store that can never be used again.
+
+    That is temporary files older than TMP_MAX_AGE (younger ones may still be written) and caches stamped
+    with an older store revision (ie DrawSpeed profiles).
+    """
+    revision = store.revision()
+    for path in glob.glob(store.sidecar_path("*.tmp")):
+        try:
+            if os.path.getmtime(path) < time.time() - TMP_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            # Renamed or removed by its writer meanwhile
+            pass
+    for path in glob.glob(store.sidecar_path("*.npz")):
+        if path == store.sidecar_path(CACHE_NAME):
+            continue
+        try:
+            with np.load(path) as cached:
+                stale = "revision" in cached.files and str(cached["revision"]) != revision
+        except (IOError, OSError, ValueError):
+            stale = True
+        if stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def load_samples(store, logger=None):
+    """
+    Get every sample of store, using and updating the cache file next to it.
+
+    @param store a SpeedStore store
+    @param logger optional logger
+    @retval samples dictionary
+    """
+    path = store.sidecar_path(CACHE_NAME)
+    samples, token = load(path)
+    new_token, pairs, rebuild = store.changes_since(token if samples is not None else None)
+    if pairs is None:
+        return samples
+    if rebuild or samples is None:
+        if logger:
+            logger.info("Rebuilding {0} from {1} results".format(path, len(pairs)))
+        samples = build_samples(pairs)
+    else:
+        if logger:
+            logger.info("Adding {0} new results to {1}".format(len(pairs), path))
+        samples = concatenate(samples, build_samples(pairs))
+    save(path, samples, new_token)
+    evict_stale(store)
+    return samples
@@ -0,0 +1,460 @@
+"""
+Collect results pushed by runners on many hosts into one shared sqlite store.
+
+Runners started with `-push http://collector:8080` send batches with SpeedExporter. The collector answers:
+    POST /samples       a gzipped batch, see SpeedExporter. Replies once the batch is committed,
+                        503 while the collector is busy so the exporter retries later
+    POST /changes       {"token": ...} what changed since token, see SpeedStore changes_since.
+                        Replies {"token", "rebuild", "pairs", "after"}, while after is not null the next
+                        page is POSTed as {"token": the token replied, "after": after}
+    GET  /revision      the store's revision
+    GET  /query         results, takes start, end, ssid, Provider, ip_address and probe parameters
+                        (anything else is a 400).
+                        Replies {"pairs", "after"}, while after is not null ask again with after=after
+    GET  /events        events, takes kind, start and end parameters
+The read side is what SpeedStore.HttpStore uses, so `runner.py draw -store http://collector:8080` works.
+
+One writer thread owns the store. Request threads queue decoded batches for it and the writer commits
+everything queued in a single transaction, so a few thousand results per second cost a handful of
+commits. Memory stays bounded: batches and requests in flight are capped and bigger bodies are refused.
+A batch pushed again (ie its reply was lost) is not stored twice, see SqliteStore.insert_new.
+
+ie) python runner.py collect -store sqlite:///all-probes.db -port 8080
+"""
+__author__ = "Paul Pfeffer"
+
+import gzip
+import io
+import json
+import signal
+import sqlite3
+import threading
+import zlib
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlparse, parse_qsl
+    import queue
+    import socketserver
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urlparse import urlparse, parse_qsl
+    import Queue as queue
+    import SocketServer as socketserver
+
+import SpeedStore
+
+# Largest batch body accepted, before and after gzip.
+MAX_BODY_BYTES = 8 * 1024 * 1024
+MAX_BATCH_BYTES = 32 * 1024 * 1024
+MAX_BATCH_SAMPLES = 10000
+
+# Most results in one reply to a reader, so a reply never holds the whole store.
+PAGE_SAMPLES = 5000
+
+# Parameters GET /query takes besides after, see SqliteStore.query_page.
+QUERY_PARAMS = ["start", "end", "ssid", "Provider", "ip_address", "probe"]
+
+
+def decode_batch(body, gzipped=True):
+    """
+    Read a batch pushed by SpeedExporter.
+
+    @param body the request body
+    @param gzipped True when the body is gzipped (default:True)
+    @retval (probe, list of (timestamp, result))
+    @throws ValueError when the body is not a usable batch
+    """
+    if gzipped:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            body = decompressor.decompress(body, MAX_BATCH_BYTES)
+        except zlib.error as e:
+            raise ValueError("Body is not gzipped: {0}".format(e))
+        if decompressor.unconsumed_tail:
+            raise ValueError("Batch is larger than {0} bytes".format(MAX_BATCH_BYTES))
+    batch = json.loads(body.decode("utf-8"))
+    if not isinstance(batch, dict) or not isinstance(batch.get("samples"), list):
+        raise ValueError("Batch has no samples")
+    if len(batch["samples"]) > MAX_BATCH_SAMPLES:
+        raise ValueError("Batch has more than {0} samples".format(MAX_BATCH_SAMPLES))
+    probe = batch.get("probe")
+    pairs = []
+    for sample in batch["samples"]:
+        if not isinstance(sample, list) or len(sample) != 2 or not isinstance(sample[1], dict):
+            raise ValueError("Samples must be [timestamp, result] pairs")
+        timestamp, result = sample
+        result["probe"] = probe
+        pairs.append((timestamp[:19], result))
+    return probe, pairs
+
+
+class _Batch(object):
+    """A decoded batch waiting for the writer."""
+
+    def __init__(self, pairs):
+        """
+        Initialize _Batch.
+
+        @param pairs list of (timestamp, result)
+        """
+        super(_Batch, self).__init__()
+        self.pairs = pairs
+        self.done = threading.Event()
+        self.error = None
+
+
+class _CollectorHandler(BaseHTTPRequestHandler):
+    """Answer exporters and HttpStore readers."""
+
+    def log_message(self, format, *args):
+        """Log requests at debug level instead of printing them."""
+        if self.server.collector.logger:
+            self.server.collector.logger.debug(format % args)
+
+    def _reply(self, code, reply):
+        """Send a json reply, gzipped when the client accepts it."""
+        content = json.dumps(reply).encode("utf-8")
+        gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+        if gzipped:
+            buf = io.BytesIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1) as f:
+                f.write(content)
+            content = buf.getvalue()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        if gzipped:
+            self.send_header("Content-Encoding", "gzip")
+        if code == 503:
+            self.send_header("Retry-After", "5")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _read_body(self):
+        """Return the request body, None (after replying) when it is too large."""
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY_BYTES:
+            self._reply(413, {"ok": False, "error": "Body is larger than {0} bytes".format(MAX_BODY_BYTES)})
+            return None
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        """Take a batch or answer changes_since."""
+        path = urlparse(self.path).path
+        if path not in ("/samples", "/changes"):
+            self._reply(404, {"ok": False, "error": "Unknown path {0}".format(path)})
+            return
+        collector = self.server.collector
+        if not collector.requests.acquire(False):
+            self._reply(503, {"ok": False, "error": "Too many requests"})
+            return
+        try:
+            body = self._read_body()
+            if body is None:
+                return
+            try:
+                if path == "/changes":
+                    request = json.loads(body.decode("utf-8"))
+                    self._reply(200, collector.changes_page(request["token"], request.get("after")))
+                    return
+                probe, pairs = decode_batch(body, self.headers.get("Content-Encoding") == "gzip")
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {"ok": False, "error": str(e)})
+                return
+            code, reply = collector.ingest(pairs)
+            self._reply(code, reply)
+        finally:
+            collector.requests.release()
+
+    def do_GET(self):
+        """Answer revision, query and events."""
+        url = urlparse(self.path)
+        params = dict(parse_qsl(url.query))
+        collector = self.server.collector
+        try:
+            if url.path == "/revision":
+                self._reply(200, {"revision": collector.read("revision")})
+            elif url.path == "/query":
+                after = int(params.pop("after", 0))
+                unknown = sorted(key for key in params if key not in QUERY_PARAMS)
+                if unknown:
+                    raise ValueError("Unknown parameter {0}".format(", ".join(unknown)))
+                pairs, after = collector.read("query_page", after, PAGE_SAMPLES, **params)
+                self._reply(200, {"pairs": pairs, "after": after})
+            elif url.path == "/events":
+                self._reply(200, collector.read("events", params.get("kind"), params.get("start"), params.get("end")))
+            else:
+                self._reply(404, {"ok": False, "error": "Unknown path {0}".format(url.path)})
+        except ValueError as e:
+            self._reply(400, {"ok": False, "error": str(e)})
+
+
+class _CollectorServer(socketserver.ThreadingMixIn, HTTPServer):
+    """HTTP server that handles every request in its own thread."""
+    daemon_threads = True
+
+
+class SpeedCollector(object):
+    """Serve exporters and readers, writing every batch to one sqlite store."""
+
+    def __init__(self, store_uri, host="127.0.0.1", port=8080, logger=None, max_batches=64, max_requests=128,
+                 commit_timeout=30.0):
+        """
+        Initialize SpeedCollector.
+
+        @param store_uri a sqlite store uri, see SpeedStore.open_store. ie) sqlite:///all-probes.db
+        @param host address to listen on (default:127.0.0.1)
+        @param port port to listen on, 0 picks a free one (default:8080)
+        @param logger optional logger
+        @param max_batches most batches waiting for the writer (default:64)
+        @param max_requests most requests handled at once, more get a 503 (default:128)
+        @param commit_timeout seconds a batch may wait for its commit before the exporter is told to retry
+                              (default:30.0)
+        @throws ValueError when store_uri is not a sqlite store
+        """
+        super(SpeedCollector, self).__init__()
+        self.store_uri = store_uri
+        self.logger = logger
+        self.commit_timeout = commit_timeout
+        store = SpeedStore.open_store(store_uri, logger)
+        store.close()
+        if not isinstance(store, SpeedStore.SqliteStore):
+            raise ValueError("The collector needs a sqlite store, ie) sqlite:///all-probes.db")
+        self.queue = queue.Queue(max_batches)
+        self.requests = threading.BoundedSemaphore(max_requests)
+        self.received = 0
+        self.inserted = 0
+        self.server = _CollectorServer((host, port), _CollectorHandler)
+        self.server.collector = self
+        self.address = self.server.server_address
+        self.writer = threading.Thread(target=self._write, name="collector-writer")
+        self.writer.daemon = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="collector")
+        self.thread.daemon = True
+
+    def start(self):
+        """Start serving in the background."""
+        self.writer.start()
+        self.thread.start()
+        if self.logger:
+            self.logger.info("Collecting into {0} on http://{1}:{2}".format(self.store_uri, *self.address[:2]))
+
+    def close(self):
+        """Stop serving, commit what is queued and close the store."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.queue.put(None)
+        self.writer.join()
+
+    def ingest(self, pairs):
+        """
+        Hand a batch to the writer and wait for it to be committed.
+
+        @param pairs list of (timestamp, result)
+        @retval (http status, reply dictionary)
+        """
+        batch = _Batch(pairs)
+        try:
+            self.queue.put(batch, timeout=self.commit_timeout)
+        except queue.Full:
+            return 503, {"ok": False, "error": "Collector is busy"}
+        batch.done.wait(self.commit_timeout)
+        if not batch.done.is_set():
+            return 503, {"ok": False, "error": "Commit timed out"}
+        if batch.error:
+            return 503, {"ok": False, "error": batch.error}
+        return 200, {"ok": True, "received": len(pairs)}
+
+    def _write(self):
+        """Commit queued batches, everything queued at once goes in one transaction."""
+        store = SpeedStore.open_store(self.store_uri, self.logger)
+        stop = False
+        try:
+            while not stop:
+                batch = self.queue.get()
+                if batch is None:
+                    break
+                batches = [batch]
+                while True:
+                    try:
+                        batch = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if batch is None:
+                        stop = True
+                        break
+                    batches.append(batch)
+                pairs = [pair for batch in batches for pair in batch.pairs]
+                try:
+                    self.inserted += store.insert_new(pairs)
+                    self.received += len(pairs)
+                except sqlite3.Error as e:
+                    if self.logger:
+                        self.logger.error("Could not store {0} result(s): {1}".format(len(pairs), e))
+                    for batch in batches:
+                        batch.error = str(e)
+                for batch in batches:
+                    batch.done.set()
+        finally:
+            store.close()
+
+    def read(self, method, *args, **kwargs):
+        """Call a read method of the store on a connection of this request's own."""
+        store = SpeedStore.open_store(self.store_uri, self.logger)
+        try:
+            return getattr(store, method)(*args, **kwargs)
+        finally:
+            store.close()
+
+    def changes_page(self, token, after=None):
+        """
+        Return a page of what changed since token, see SqliteStore.changed_rows.
+
+        @param token what the reader last got, from the first page on the token of the first page
+        @param after None for the first page, then the after of the previous page
+        @retval reply dictionary with token, rebuild, pairs (None when nothing changed) and after
+        """
+        store = SpeedStore.open_store(self.store_uri, self.logger)
+        try:
+            rebuild = False
+            if after is None:
+                token, after, rebuild = store.changed_rows(token)
+                if after is None:
+                    return {"token": token, "rebuild": False, "pairs": None, "after": None}
+            pairs, after = store.rows_after(after, token["last_id"], PAGE_SAMPLES)
+            return {"token": token, "rebuild": rebuild, "pairs": pairs, "after": after}
+        finally:
+            store.close()
+
+    def serve_forever(self):
+        """Serve until SIGTERM or SIGINT."""
+        stop = threading.Event()
+        for name in ("SIGTERM", "SIGINT"):
+            signal.signal(getattr(signal, name), lambda signum, frame: stop.set())
+        self.start()
+        try:
+            while not stop.is_set():
+                stop.wait(1)
+        finally:
+            self.close()
+
+
+def _wait_for(condition, what, timeout=30.0):
+    """Poll condition until it is true, raise AssertionError after timeout seconds."""
+    import time
+
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting for {0}".format(what))
+        time.sleep(0.05)
+
+
+def check_spool(directory, batches=5, batch_size=50):
+    """
+    Push to a port nobody listens on, then start a collector there and check every result arrives once.
+
+    @param directory an empty directory for the spool and the collector's store
+    @param batches number of batches pushed while the collector is down (default:5)
+    @param batch_size results per batch (default:50)
+    @throws AssertionError when results are not spooled or not delivered exactly once
+    """
+    import datetime
+    import os
+    import socket
+
+    import SpeedExporter
+
+    probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    url = "http://127.0.0.1:{0}".format(port)
+    spool_dir = os.path.join(directory, "spool")
+    first = datetime.datetime(2017, 1, 1)
+    timestamps = [(first + datetime.timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S")
+                  for i in range(batches * batch_size)]
+
+    exporter = SpeedExporter.PushExporter(url, "offline", spool_dir, batch_size=batch_size, flush_interval=3600)
+    for batch in range(batches):
+        for timestamp in timestamps[batch * batch_size:(batch + 1) * batch_size]:
+            exporter.add(timestamp, {"download": 9.5e7, "upload": 1.2e7, "ping": 23.4, "ssid": "home"})
+        _wait_for(lambda: len(exporter._spooled()) == batch + 1, "batch {0} to be spooled".format(batch))
+    exporter.close()
+    counts = [exporter._spool_count(path) for path in exporter._spooled()]
+    if counts != [batch_size] * batches or exporter.sent:
+        raise AssertionError("Expected {0} spool files of {1} results, found {2}".format(batches, batch_size, counts))
+    print("spooled {0} results in {1} files while the collector was down".format(sum(counts), len(counts)))
+
+    collector = SpeedCollector("sqlite:///" + os.path.join(directory, "spool.db"), port=port)
+    collector.start()
+    try:
+        exporter = SpeedExporter.PushExporter(url, "offline", spool_dir, batch_size=batch_size)
+        _wait_for(lambda: not exporter._spooled(), "the spool to drain")
+        exporter.close()
+        stored = [timestamp for timestamp, result in collector.read("query", probe="offline")]
+    finally:
+        collector.close()
+    if stored != timestamps:
+        raise AssertionError("Expected {0} results once each, the collector has {1} ({2} distinct)".format(
+            len(timestamps), len(stored), len(set(stored))))
+    print("delivered all {0} spooled results exactly once".format(len(stored)))
+
+
+def main():
+    """Push synthetic results from several threads to a collector on localhost and time it, then check_spool."""
+    import datetime
+    import os
+    import shutil
+    import tempfile
+    import time
+
+    import SpeedExporter
+
+    try:
+        from urllib.request import Request, urlopen
+    except ImportError:  # python 2
+        from urllib2 import Request, urlopen
+
+    directory = tempfile.mkdtemp()
+    try:
+        collector = SpeedCollector("sqlite:///" + os.path.join(directory, "collector.db"), port=0)
+        collector.start()
+        url = "http://{0}:{1}/samples".format(*collector.address[:2])
+
+        def push(probe, batches, batch_size):
+            first = datetime.datetime(2017, 1, 1)
+            for batch in range(batches):
+                pairs = [((first + datetime.timedelta(minutes=batch * batch_size + i)).strftime("%Y-%m-%d %H:%M:%S"),
+                          {"download": 9.5e7, "upload": 1.2e7, "ping": 23.4, "ssid": "home",
+                           "Provider": "Comcast Cable", "ip_address": "73.12.1.4", "all_info": "x" * 300})
+                         for i in range(batch_size)]
+                body = SpeedExporter.encode_batch(probe, pairs)
+                urlopen(Request(url, data=body, headers={"Content-Encoding": "gzip"})).close()
+
+        probes, batches, batch_size = 16, 20, 250
+        start = time.time()
+        threads = [threading.Thread(target=push, args=("probe-{0}".format(i), batches, batch_size))
+                   for i in range(probes)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        total = probes * batches * batch_size
+        print("pushed {0} results from {1} probes in {2:.2f}s ({3:.0f} results/s)".format(
+            total, probes, elapsed, total / elapsed))
+
+        # Pushing the same results again stores nothing new.
+        push("probe-0", batches, batch_size)
+        print("stored {0} of {1} received results".format(collector.inserted, collector.received))
+        collector.close()
+
+        os.mkdir(os.path.join(directory, "spool-check"))
+        check_spool(os.path.join(directory, "spool-check"))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+Push results from a runner to a SpeedCollector.
+
+PushExporter buffers results and sends them in gzipped json batches from a background thread, so a slow
+or unreachable collector never delays a test. A batch that cannot be sent is written to a spool
+directory and sent again, oldest first, once the collector answers. Results therefore arrive even
+after the collector or the network was down for days.
+
+A batch on the wire (POST /samples, Content-Encoding: gzip):
+    {
+        "probe": name of the runner that measured the results,
+        "samples": [["%Y-%m-%d %H:%M:%S", result dictionary], ...]
+    }
+"""
+__author__ = "Paul Pfeffer"
+
+import collections
+import glob
+import gzip
+import io
+import json
+import os
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:  # python 2
+    from urllib2 import Request, urlopen, HTTPError, URLError
+
+# Replies that mean the collector is busy or down rather than that the batch is bad.
+RETRY_STATUS = [408, 429, 500, 502, 503, 504]
+
+
+def encode_batch(probe, pairs):
+    """
+    Build the body of a batch.
+
+    @param probe name of the probe
+    @param pairs list of (timestamp, result)
+    @retval gzipped json bytes
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(json.dumps({"probe": probe, "samples": pairs}).encode("utf-8"))
+    return buf.getvalue()
+
+
+class PushExporter(object):
+    """Send results to a collector in batches."""
+
+    def __init__(self, url, probe, spool_dir=None, logger=None, batch_size=100, flush_interval=60.0,
+                 max_pending=10000, timeout=30.0, max_backoff=600.0):
+        """
+        Initialize PushExporter and start its thread.
+
+        @param url the collector's address. ie) http://collector:8080
+        @param probe name the results are tagged with at the collector. ie) the hostname
+        @param spool_dir directory unsent batches are kept in (default:None, kept in memory)
+        @param logger optional logger
+        @param batch_size most results sent in one request (default:100)
+        @param flush_interval seconds a result may wait for its batch to fill up (default:60.0)
+        @param max_pending most unsent results kept in memory without a spool_dir, older ones are dropped
+                           (default:10000)
+        @param timeout seconds to wait for the collector to answer (default:30.0)
+        @param max_backoff longest wait between retries in seconds (default:600.0)
+        """
+        super(PushExporter, self).__init__()
+        self.url = url.rstrip("/") + "/samples"
+        self.probe = probe
+        self.spool_dir = spool_dir
+        self.logger = logger
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.first_added = None
+        # Unsent batches as (number of results, body) when there is no spool_dir
+        self.unsent = collections.deque()
+        self.unsent_count = 0
+        self.sequence = 0
+        self.backoff = 0.0
+        self.sent = 0
+        self.closing = False
+        self.wakeup = threading.Event()
+
+        if spool_dir and not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        if spool_dir and self._spooled():
+            # Retry what an earlier run left behind right away
+            self.backoff = 1.0
+        self.thread = threading.Thread(target=self._run, name="push-exporter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, timestamp, result):
+        """Queue a result, it is sent once its batch is full or flush_interval passed."""
+        with self.lock:
+            if not self.buffer:
+                self.first_added = time.time()
+            self.buffer.append((timestamp, result))
+            full = len(self.buffer) >= self.batch_size
+        if full or not self.flush_interval:
+            self.wakeup.set()
+
+    def status(self):
+        """Return how many results are waiting to be sent."""
+        with self.lock:
+            buffered = len(self.buffer)
+        if self.spool_dir:
+            unsent = sum(self._spool_count(path) for path in self._spooled())
+        else:
+            unsent = self.unsent_count
+        return {
+            "url": self.url,
+            "buffered": buffered,
+            "spooled": unsent,
+            "sent": self.sent,
+            "backoff": self.backoff
+        }
+
+    def _log(self, level, message):
+        """Log when there is a logger."""
+        if self.logger:
+            getattr(self.logger, level)(message)
+
+    def _post(self, body, count):
+        """
+        Send one batch.
+
+        @retval True when the batch is done with (stored or rejected for good), False to try again later
+        """
+        request = Request(self.url, data=body, headers={"Content-Type": "application/json",
+                                                         "Content-Encoding": "gzip"})
+        try:
+            urlopen(request, timeout=self.timeout).close()
+        except HTTPError as e:
+            if e.code in RETRY_STATUS:
+                self._log("warning", "Collector {0} is busy ({1}), will retry".format(self.url, e.code))
+                return False
+            self._log("error", "Collector {0} rejected {1} result(s): {2}".format(self.url, count, e))
+            return True
+        except (URLError, IOError, OSError) as e:
+            self._log("warning", "Cannot reach collector {0}: {1}".format(self.url, e))
+            return False
+        self.sent += count
+        return True
+
+    def _spooled(self):
+        """Return the spool files oldest first."""
+        return sorted(glob.glob(os.path.join(self.spool_dir, "*.json.gz")))
+
+    @staticmethod
+    def _spool_count(path):
+        """Return the number of results in a spool file, it is part of the name."""
+        return int(os.path.basename(path).split("-")[2].split(".")[0])
+
+    def _keep(self, body, count):
+        """Keep a batch that could not be sent."""
+        if self.spool_dir:
+            self.sequence += 1
+            name = "{0:.6f}-{1:06d}-{2}.json.gz".format(time.time(), self.sequence, count)
+            path = os.path.join(self.spool_dir, name)
+            with open(path + ".tmp", 'wb') as f:
+                f.write(body)
+            os.rename(path + ".tmp", path)
+            return
+        self.unsent.append((count, body))
+        self.unsent_count += count
+        while self.unsent_count > self.max_pending:
+            dropped, _ = self.unsent.popleft()
+            self.unsent_count -= dropped
+            self._log("error", "Dropped {0} unsent result(s), set a spool directory to keep them".format(dropped))
+
+    def _drain(self):
+        """Send kept batches oldest first, return False when the collector could not take them."""
+        if self.spool_dir:
+            for path in self._spooled():
+                with open(path, 'rb') as f:
+                    body = f.read()
+                if not self._post(body, self._spool_count(path)):
+                    return False
+                os.remove(path)
+            return True
+        while self.unsent:
+            count, body = self.unsent[0]
+            if not self._post(body, count):
+                return False
+            self.unsent.popleft()
+            self.unsent_count -= count
+        return True
+
+    def _take_batch(self):
+        """Remove and return up to batch_size buffered results."""
+        with self.lock:
+            pairs, self.buffer = self.buffer[:self.batch_size], self.buffer[self.batch_size:]
+            self.first_added = time.time() if self.buffer else None
+        return pairs
+
+    def _ship(self):
+        """
+        Send kept batches, then the buffer.
+
+        When the collector cannot be reached the buffer is kept as batches too, so memory stays bounded
+        and nothing buffered is lost if the runner dies.
+
+        @retval True when everything was sent
+        """
+        reachable = self._drain()
+        while True:
+            pairs = self._take_batch()
+            if not pairs:
+                return reachable
+            body = encode_batch(self.probe, pairs)
+            if not reachable or not self._post(body, len(pairs)):
+                reachable = False
+                self._keep(body, len(pairs))
+
+    def _wait_time(self):
+        """Return how long the thread may sleep, None until woken up."""
+        if self.backoff:
+            return self.backoff
+        with self.lock:
+            first_added = self.first_added
+        if first_added is None:
+            return None
+        return max(0.0, first_added + self.flush_interval - time.time())
+
+    def _run(self):
+        """Send batches until closed."""
+        while not self.closing:
+            self.wakeup.wait(self._wait_time())
+            self.wakeup.clear()
+            if self.closing:
+                break
+            with self.lock:
+                due = self.buffer and (len(self.buffer) >= self.batch_size or
+                                       time.time() - self.first_added >= self.flush_interval)
+            if not due and not self.backoff:
+                continue
+            if self._ship():
+                self.backoff = 0.0
+            else:
+                self.backoff = min(self.max_backoff, max(1.0, self.backoff * 2))
+
+    def close(self):
+        """Stop the thread and make one last attempt to send everything, what cannot be sent is kept."""
+        self.closing = True
+        self.wakeup.set()
+        self.thread.join()
+        self._ship()
+        remaining = self.status()
+        if remaining["spooled"]:
+            self._log("warning", "{0} result(s) are left to push to {1}".format(remaining["spooled"], self.url))
@@ -0,0 +1,336 @@
+"""
+Parse the output of speedtest-cli into a result dictionary.
+
+Supports the three output formats of speedtest-cli:
+    text    the default human readable output
+    json    speedtest-cli --json
+    csv     speedtest-cli --csv
+
+Units are normalized when results are parsed so results only ever hold numbers:
+    download, upload    bits per second
+    ping                milliseconds
+
+All regexes are compiled once at import and the text format is parsed in a single pass.
+"""
+__author__ = "Paul Pfeffer"
+
+import csv
+import json
+import math
+import re
+import time
+
+FORMATS = ["text", "json", "csv"]
+
+# Command line flag speedtest-cli needs for each format
+FORMAT_FLAGS = {"text": [], "json": ["--json"], "csv": ["--csv"]}
+
+# Multiplier to bits per second, keyed on the lower cased unit
+RATE_UNITS = {
+    "bit/s": 1.0, "kbit/s": 1e3, "mbit/s": 1e6, "gbit/s": 1e9,
+    "byte/s": 8.0, "kbyte/s": 8e3, "mbyte/s": 8e6, "gbyte/s": 8e9,
+    "bps": 1.0, "kbps": 1e3, "mbps": 1e6, "gbps": 1e9,
+}
+
+# Multiplier to milliseconds
+TIME_UNITS = {"us": 1e-3, "ms": 1.0, "s": 1e3}
+
+_NUMBER = r"\d+(?:\.\d+)?"
+_RATE_UNIT = r"[KkMmGg]?(?:bit|byte)/s|[KkMmGg]?bps"
+_IP = r"[0-9A-Fa-f:.]*[0-9A-Fa-f]"
+
+# Every alternative finds its own end so output whose lines were joined without separators
+# (as saved by older versions) parses too.
+TEXT_REGEX = re.compile(
+    r"Testing from (?P<provider>.+?) \((?P<ip>" + _IP + r")\)"
+    r"|Hosted by .+?: (?P<ping>" + _NUMBER + r") ?(?P<ping_unit>ms|us|s)"
+    r"|Download: (?P<download>" + _NUMBER + r") ?(?P<download_unit>" + _RATE_UNIT + r")"
+    r"|Upload: (?P<upload>" + _NUMBER + r") ?(?P<upload_unit>" + _RATE_UNIT + r")"
+)
+SSID_REGEX = re.compile(r"(?<!B)SSID\s+: ([^\r\n]+)")
+IP_REGEX = re.compile(r"^(?:\d{1,3}(?:\.\d{1,3}){3}|[0-9A-Fa-f]*:[0-9A-Fa-f:.]*)$")
+RATE_REGEX = re.compile(r"^\s*(" + _NUMBER + r")\s*(" + _RATE_UNIT + r")?\s*$")
+TIME_REGEX = re.compile(r"^\s*(" + _NUMBER + r")\s*(ms|us|s)?\s*$")
+
+
+class ParseError(ValueError):
+    """The output does not contain a complete speed test result."""
+    pass
+
+
+def to_bits_per_second(value, default_unit="bit/s"):
+    """
+    Convert a rate to bits per second.
+
+    @param value a number or a string like "95.3 Mbit/s"
+    @param default_unit unit of value when it has none (default:bit/s)
+    @retval float
+    """
+    if isinstance(value, (int, float)):
+        return float(value) * RATE_UNITS[default_unit.lower()]
+    match = RATE_REGEX.match(value)
+    if not match:
+        raise ParseError("Not a rate: {0!r}".format(value))
+    return float(match.group(1)) * RATE_UNITS[(match.group(2) or default_unit).lower()]
+
+
+def to_milliseconds(value, default_unit="ms"):
+    """
+    Convert a duration to milliseconds.
+
+    @param value a number or a string like "23.4 ms"
+    @param default_unit unit of value when it has none (default:ms)
+    @retval float
+    """
+    if isinstance(value, (int, float)):
+        return float(value) * TIME_UNITS[default_unit]
+    match = TIME_REGEX.match(value)
+    if not match:
+        raise ParseError("Not a duration: {0!r}".format(value))
+    return float(match.group(1)) * TIME_UNITS[match.group(2) or default_unit]
+
+
+def normalize_result(result):
+    """
+    Convert the speeds of a result saved before units were normalized ("95.3 Mbit/s") to numbers.
+
+    Results that already hold numbers are returned untouched. A value that cannot be converted
+    (ie "12,5 ms") is moved to result["unparsed"] so it is kept, and the result is marked failed
+    with an "error" key, one bad result never keeps the others from loading.
+
+    @param result a result dictionary
+    @retval the same dictionary
+    """
+    for key, convert in (("download", to_bits_per_second), ("upload", to_bits_per_second),
+                         ("ping", to_milliseconds)):
+        if not isinstance(result.get(key), (type(u""), type(""))):
+            continue
+        try:
+            result[key] = convert(result[key])
+        except ParseError as e:
+            result.setdefault("unparsed", {})[key] = result[key]
+            result[key] = None
+            result.setdefault("error", "Saved result cannot be read: {0}".format(e))
+    return result
+
+
+def parse_ssid(output):
+    """
+    Return the wireless network name found in output or "wired".
+
+    @param output raw output, on windows it ends with the output of netsh wlan show interface
+    """
+    match = SSID_REGEX.search(output)
+    return match.group(1).strip() if match else "wired"
+
+
+def parse_text(output):
+    """
+    Parse the default output of speedtest-cli.
+
+    @param output raw output
+    @retval result dictionary
+    """
+    found = {}
+    for match in TEXT_REGEX.finditer(output):
+        for key, val in match.groupdict().items():
+            if val is not None and key not in found:
+                found[key] = val
+    missing = [key for key in ("provider", "ping", "download", "upload") if key not in found]
+    if missing:
+        raise ParseError("Missing {0} in speedtest output".format(", ".join(missing)))
+    return {
+        "Provider": found["provider"],
+        "ip_address": found["ip"],
+        "ping": float(found["ping"]) * TIME_UNITS[found["ping_unit"]],
+        "download": float(found["download"]) * RATE_UNITS[found["download_unit"].lower()],
+        "upload": float(found["upload"]) * RATE_UNITS[found["upload_unit"].lower()],
+    }
+
+
+def parse_json(output):
+    """
+    Parse the output of speedtest-cli --json.
+
+    @param output raw output
+    @retval result dictionary
+    """
+    start = output.find("{")
+    if start < 0:
+        raise ParseError("No json in speedtest output")
+    try:
+        data, _ = json.JSONDecoder().raw_decode(output, start)
+        client = data.get("client") or {}
+        result = {
+            "Provider": client.get("isp"),
+            "ip_address": client.get("ip"),
+            "ping": float(data["ping"]),
+            "download": float(data["download"]),
+            "upload": float(data["upload"]),
+        }
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        raise ParseError("Bad json in speedtest output: {0}".format(e))
+    for key in ("bytes_sent", "bytes_received"):
+        if data.get(key) is not None:
+            result[key] = int(data[key])
+    return result
+
+
+def parse_csv(output):
+    """
+    Parse the output of speedtest-cli --csv.
+
+    Columns: Server ID,Sponsor,Server Name,Timestamp,Distance,Ping,Download,Upload,Share,IP Address
+
+    @param output raw output
+    @retval result dictionary
+    """
+    for row in csv.reader(output.splitlines()):
+        if len(row) < 10 or row[0] == "Server ID":
+            continue
+        try:
+            result = {
+                "Provider": None,
+                "ip_address": None,
+                "ping": float(row[5]),
+                "download": float(row[6]),
+                "upload": float(row[7]),
+            }
+        except ValueError:
+            continue
+        ip_addr = row[9].split()[0] if row[9].strip() else ""
+        if IP_REGEX.match(ip_addr):
+            result["ip_address"] = ip_addr
+        return result
+    raise ParseError("No csv row in speedtest output")
+
+
+PARSERS = {"text": parse_text, "json": parse_json, "csv": parse_csv}
+
+
+def parse(output, output_format="text"):
+    """
+    Parse speedtest-cli output into a result dictionary with normalized units.
+
+    @param output raw output (optionally followed by netsh output on windows)
+    @param output_format one of FORMATS (default:text)
+    @retval result dictionary with Provider, ip_address, ping, download, upload, ssid and all_info
+    @throws ParseError when output does not hold a complete result
+    """
+    result = PARSERS[output_format](output)
+    for key in ("ping", "download", "upload"):
+        # float() and json take nan and inf, a test never measures them
+        if math.isnan(result[key]) or math.isinf(result[key]):
+            raise ParseError("Not a finite {0}: {1}".format(key, result[key]))
+    result["ssid"] = parse_ssid(output)
+    result["all_info"] = output
+    return result
+
+
+# Outputs used by main() to check and time the parsers, with what parse must find in them.
+COMCAST = {"Provider": "Comcast Cable", "ip_address": "73.12.1.4", "ping": 23.456,
+           "download": 95.12e6, "upload": 11.86e6, "ssid": "wired"}
+SAMPLES = [
+    ("text", "Retrieving speedtest.net configuration...Testing from Comcast Cable (73.12.1.4)..."
+             "Retrieving speedtest.net server list...Selecting best server based on ping..."
+             "Hosted by Wave (Seattle, WA) [12.45 km]: 23.456 msTesting download speed"
+             "................................................................................"
+             "Download: 95.12 Mbit/sTesting upload speed......................................"
+             "Upload: 11.86 Mbit/s",
+     COMCAST),
+    ("text", "Retrieving speedtest.net configuration...\nTesting from Comcast Cable (73.12.1.4)...\n"
+             "Retrieving speedtest.net server list...\nSelecting best server based on ping...\n"
+             "Hosted by Wave (Seattle, WA) [12.45 km]: 23.456 ms\nTesting download speed"
+             "................................................................................\n"
+             "Download: 95.12 Mbit/s\nTesting upload speed......................................\n"
+             "Upload: 11.86 Mbit/s",
+     COMCAST),
+    ("text", "Testing from Example ISP (2001:db8:85a3::8a2e:370:7334)...Hosted by Foo (Bar) [1.00 km]: 8.1 ms"
+             "Download: 1.2 Gbit/sUpload: 950.5 Kbit/s",
+     {"Provider": "Example ISP", "ip_address": "2001:db8:85a3::8a2e:370:7334", "ping": 8.1,
+      "download": 1.2e9, "upload": 950.5e3, "ssid": "wired"}),
+    ("text", "Testing from Slow DSL (10.0.0.1)...Hosted by Foo (Bar) [300.21 km]: 1.2 s"
+             "Download: 512.00 Kbyte/sUpload: 64.00 Kbyte/s"
+             "    Name                   : Wi-Fi\r\n    SSID                   : home-net\r\n"
+             "    BSSID                  : 00:11:22:33:44:55\r\n",
+     {"Provider": "Slow DSL", "ip_address": "10.0.0.1", "ping": 1200.0,
+      "download": 4096e3, "upload": 512e3, "ssid": "home-net"}),
+    ("json", '{"download": 95120000.5, "upload": 11860000.1, "ping": 23.456, "server": {"sponsor": "Wave"}, '
+             '"timestamp": "2017-01-01T00:00:00.000000Z", "bytes_sent": 15400000, "bytes_received": 120000000, '
+             '"share": null, "client": {"ip": "73.12.1.4", "isp": "Comcast Cable"}}',
+     dict(COMCAST, download=95120000.5, upload=11860000.1, bytes_sent=15400000, bytes_received=120000000)),
+    ("csv", '5029,"Wave, Inc",Seattle,2017-01-01T00:00:00.000000Z,12.45,23.456,95120000.5,11860000.1,,73.12.1.4',
+     dict(COMCAST, Provider=None, download=95120000.5, upload=11860000.1)),
+    ("csv", "Server ID,Sponsor,Server Name,Timestamp,Distance,Ping,Download,Upload,Share,IP Address\n"
+            "5029,Wave,Seattle,2017-01-01T00:00:00.000000Z,12.45,23.456,95120000.5,11860000.1,,2001:db8::1",
+     dict(COMCAST, Provider=None, ip_address="2001:db8::1", download=95120000.5, upload=11860000.1)),
+]
+
+# Outputs parse must reject.
+BAD_SAMPLES = [
+    ("json", '{"download": NaN, "upload": 11860000.1, "ping": 23.456}'),
+    ("json", '{"download": 95120000.5, "upload": 1e999, "ping": 23.456}'),
+    ("csv", '5029,Wave,Seattle,2017-01-01T00:00:00.000000Z,12.45,inf,95120000.5,11860000.1,,73.12.1.4'),
+]
+
+
+def _mismatches(result, expected):
+    """Return the keys of expected that result does not hold (numbers within a relative 1e-9)."""
+    wrong = []
+    for key, val in expected.items():
+        found = result.get(key)
+        if isinstance(val, float) and isinstance(found, float):
+            if abs(found - val) > 1e-9 * abs(val):
+                wrong.append(key)
+        elif found != val:
+            wrong.append(key)
+    return wrong
+
+
+def main():
+    """Check the parsers against SAMPLES, fuzz them and time them."""
+    import random
+
+    random.seed(0)
+    for output_format, output, expected in SAMPLES:
+        result = parse(output, output_format)
+        print("{0:4} {1} {2} ping={3}ms down={4}bit/s up={5}bit/s ssid={6}".format(
+            output_format, result["Provider"], result["ip_address"], result["ping"],
+            result["download"], result["upload"], result["ssid"]))
+        wrong = _mismatches(result, expected)
+        if wrong:
+            raise AssertionError("{0} sample parsed wrong {1}: {2}".format(
+                output_format, ", ".join(wrong), dict((key, result.get(key)) for key in wrong)))
+    for output_format, output in BAD_SAMPLES:
+        try:
+            parse(output, output_format)
+        except ParseError:
+            continue
+        raise AssertionError("{0} sample should be rejected: {1}".format(output_format, output))
+
+    # Truncated and mangled output must raise ParseError and nothing else, what is accepted holds finite numbers.
+    failures = 0
+    for _ in range(5000):
+        output_format, output, _ = random.choice(SAMPLES)
+        chars = list(output[:random.randint(0, len(output))])
+        for _ in range(random.randint(0, 5)):
+            if chars:
+                chars[random.randrange(len(chars))] = random.choice(" :.()/,{}\"0123456789abcMsnfNI\n")
+        try:
+            result = parse("".join(chars), output_format)
+        except ParseError:
+            failures += 1
+            continue
+        for key in ("ping", "download", "upload"):
+            if not isinstance(result[key], float) or math.isnan(result[key]) or math.isinf(result[key]):
+                raise AssertionError("Accepted {0}={1!r} from {2!r}".format(key, result[key], "".join(chars)))
+    print("fuzz: {0} of 5000 mangled outputs rejected with ParseError".format(failures))
+
+    for output_format, output, _ in SAMPLES:
+        start = time.time()
+        for _ in range(10000):
+            parse(output, output_format)
+        print("bench {0:4}: {1:.1f} us per parse".format(output_format, (time.time() - start) * 100))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Keep a store from growing forever.
+
+A RetentionPolicy says how long each level of detail is kept:
+    raw_days        raw results older than this are replaced by one aggregate per bucket (hour or day),
+                    ssid, Provider and probe. Aggregates are kept forever.
+    info_days       all_info (the raw speedtest output, most of a result's size) is dropped after this
+Schedule events (one per test) follow raw_days but are kept at least until their month is over, the runner
+rebuilds this month's data usage from them when it starts (see SpeedScheduler). Outage events are kept forever.
+
+An aggregate is saved like any result, at the timestamp of the first result it replaces:
+    {
+        "download", "upload", "ping": means of the successful tests (None when every test failed),
+        "ssid", "Provider", "ip_address", "probe": of the first result,
+        "error": "N failed test(s)" only when every test failed,
+        "aggregate": {
+            "bucket": "hour" | "day",
+            "count": number of results,
+            "errors": number of failed tests,
+            "download_min", "download_max", ... for every metric
+        }
+    }
+
+Stores apply a policy with compact(policy), see SpeedStore. Compactor runs that in a background thread.
+"""
+__author__ = "Paul Pfeffer"
+
+import datetime
+import threading
+
+BUCKET_WIDTHS = {"hour": 13, "day": 10}
+
+METRICS = ["download", "upload", "ping"]
+
+# Keys that identify the results an aggregate may combine.
+GROUP_KEYS = ["ssid", "Provider", "probe"]
+
+
+class RetentionPolicy(object):
+    """How long results are kept at each level of detail."""
+
+    def __init__(self, raw_days=None, info_days=None, bucket="hour"):
+        """
+        Initialize RetentionPolicy.
+
+        @param raw_days days raw results are kept before they are aggregated (default:None, forever)
+        @param info_days days all_info is kept (default:None, forever)
+        @param bucket aggregate raw results per hour or day (default:hour)
+        @throws ValueError for an unknown bucket or negative days
+        """
+        super(RetentionPolicy, self).__init__()
+        if bucket not in BUCKET_WIDTHS:
+            raise ValueError("Cannot aggregate per {0}. Choose from {1}".format(bucket, sorted(BUCKET_WIDTHS)))
+        if (raw_days is not None and raw_days < 0) or (info_days is not None and info_days < 0):
+            raise ValueError("Days to keep cannot be negative")
+        self.raw_days = raw_days
+        self.info_days = info_days
+        self.bucket = bucket
+
+    def cutoffs(self, now=None):
+        """
+        Return where each level of detail ends.
+
+        The raw cutoff is the start of a bucket so a bucket is never aggregated in two parts.
+
+        @param now datetime to measure from (default:None, the current time)
+        @retval (raw cutoff, info cutoff) "%Y-%m-%d %H:%M:%S" prefixes, results before them are compacted.
+                Either is None when kept forever.
+        """
+        now = now or datetime.datetime.now()
+        raw_cutoff = info_cutoff = None
+        if self.raw_days is not None:
+            raw_cutoff = (now - datetime.timedelta(days=self.raw_days)).strftime(
+                "%Y-%m-%d %H:%M:%S")[:BUCKET_WIDTHS[self.bucket]]
+        if self.info_days is not None:
+            info_cutoff = (now - datetime.timedelta(days=self.info_days)).strftime("%Y-%m-%d %H:%M:%S")
+        return raw_cutoff, info_cutoff
+
+    def schedule_cutoff(self, now=None):
+        """
+        Return where schedule events end, the raw cutoff but never past the start of the current month.
+
+        @param now datetime to measure from (default:None, the current time)
+        @retval "%Y-%m-%d %H:%M:%S" prefix, schedule events starting before it are dropped. None when kept forever.
+        """
+        now = now or datetime.datetime.now()
+        raw_cutoff = self.cutoffs(now)[0]
+        if raw_cutoff is None:
+            return None
+        return min(raw_cutoff, now.strftime("%Y-%m"))
+
+
+def is_aggregate(result):
+    """Return True for a result made by aggregate."""
+    return "aggregate" in result
+
+
+def aggregate(pairs, bucket):
+    """
+    Replace raw results by one aggregate per bucket and group, see the module docstring.
+
+    @param pairs list of (timestamp, result) sorted by timestamp, none of them aggregates
+    @param bucket hour or day
+    @retval list of (timestamp, aggregate) sorted by timestamp
+    """
+    width = BUCKET_WIDTHS[bucket]
+    groups = {}
+    order = []
+    for timestamp, result in pairs:
+        key = (timestamp[:width],) + tuple(result.get(name) for name in GROUP_KEYS)
+        if key not in groups:
+            groups[key] = (timestamp, [])
+            order.append(key)
+        groups[key][1].append(result)
+
+    aggregates = []
+    for key in order:
+        timestamp, results = groups[key]
+        ok = [result for result in results if "error" not in result]
+        summary = {"bucket": bucket, "count": len(results), "errors": len(results) - len(ok)}
+        combined = dict((name, results[0].get(name)) for name in GROUP_KEYS + ["ip_address"]
+                        if results[0].get(name) is not None)
+        for metric in METRICS:
+            values = [result[metric] for result in ok if result.get(metric) is not None]
+            combined[metric] = sum(values) / float(len(values)) if values else None
+            summary[metric + "_min"] = min(values) if values else None
+            summary[metric + "_max"] = max(values) if values else None
+        if not ok:
+            combined["error"] = "{0} failed test(s)".format(len(results))
+        combined["aggregate"] = summary
+        aggregates.append((timestamp, combined))
+    return aggregates
+
+
+def drop_info(result):
+    """Return result without its raw speedtest output."""
+    return dict((key, val) for key, val in result.items() if key != "all_info")
+
+
+class Compactor(object):
+    """Apply a retention policy to a store every so often in a background thread."""
+
+    def __init__(self, store, policy, interval=3600.0, logger=None):
+        """
+        Initialize Compactor.
+
+        @param store a SpeedStore store, the same one the runner writes to
+        @param policy RetentionPolicy
+        @param interval seconds between compactions, the first one runs right away (default:3600.0)
+        @param logger optional logger
+        """
+        super(Compactor, self).__init__()
+        self.store = store
+        self.policy = policy
+        self.interval = interval
+        self.logger = logger
+        self.last_stats = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="compactor")
+        self.thread.daemon = True
+
+    def start(self):
+        """Start compacting."""
+        self.thread.start()
+
+    def compact(self):
+        """Compact once and log what changed."""
+        self.last_stats = self.store.compact(self.policy)
+        if self.logger and any(self.last_stats.values()):
+            self.logger.info("Compacted store: {aggregated} result(s) into {aggregates} aggregate(s), "
+                             "dropped all_info of {trimmed} and {events} schedule event(s)".format(**self.last_stats))
+        return self.last_stats
+
+    def _run(self):
+        """Compact until closed, a failed compaction is logged and tried again next time."""
+        while not self.stopping.is_set():
+            try:
+                self.compact()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error("Compaction failed: {0}".format(e))
+            self.stopping.wait(self.interval)
+
+    def close(self):
+        """Stop compacting, waits for a compaction in progress."""
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join()
@@ -0,0 +1,240 @@
+"""
+Decide how long the runner waits before the next test.
+
+AdaptiveScheduler tests more often while results stray from their usual values and backs off while
+they are stable. It also keeps the data used by the tests within a daily and/or monthly budget, which
+matters on metered links since each test can move hundreds of MB.
+
+Every decision is returned as an event so it can be saved to the store and drawn:
+    {
+        "kind": "schedule",
+        "start": "%Y-%m-%d %H:%M:%S" (time of the test the decision follows),
+        "end": "%Y-%m-%d %H:%M:%S" (time of the next test),
+        "delay": seconds until the next test,
+        "reason": "deviation" | "stable" | "warmup" | "daily budget" | "monthly budget" | "fixed",
+        "deviation": largest relative deviation from the baseline,
+        "bytes": bytes used by the test,
+        "day_bytes": bytes used today,
+        "month_bytes": bytes used this month
+    }
+"""
+__author__ = "Paul Pfeffer"
+
+import calendar
+import datetime
+import re
+
+# How long speedtest-cli spends downloading and uploading, used to estimate the bytes of a test
+# when the output does not report them (only --json does).
+TEST_SECONDS = 10.0
+
+# Results read from the store to start the baseline from, see AdaptiveScheduler.seed_baseline.
+SEED_RESULTS = 20
+
+SIZE_UNITS = {"": 1, "b": 1, "kb": 1e3, "mb": 1e6, "gb": 1e9, "tb": 1e12}
+SIZE_REGEX = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?b?)\s*$", re.IGNORECASE)
+
+
+def parse_bytes(value):
+    """
+    Get bytes from a size.
+
+    @param value ie) "500MB", "2 GB" or "1000"
+    @retval integer bytes
+    @throws ValueError when value is not a size
+    """
+    match = SIZE_REGEX.match(value)
+    if not match:
+        raise ValueError("{0} is not a size. ie) 500MB".format(value))
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def test_bytes(result):
+    """
+    Return the bytes a test used.
+
+    @param result a result dictionary
+    @retval bytes reported by speedtest-cli or estimated from the speeds, None for failed tests
+    """
+    if result.get("bytes_sent") is not None and result.get("bytes_received") is not None:
+        return result["bytes_sent"] + result["bytes_received"]
+    if result.get("download") is None or result.get("upload") is None:
+        return None
+    return int((result["download"] + result["upload"]) * TEST_SECONDS / 8)
+
+
+class AdaptiveScheduler(object):
+    """Pick the delay before the next test."""
+
+    def __init__(self, base_delay, min_delay=None, max_delay=None, adaptive=True, daily_budget=None,
+                 monthly_budget=None, threshold=0.25, alpha=0.2, backoff=1.5, warmup=3, failed_bytes=0):
+        """
+        Initialize AdaptiveScheduler.
+
+        @param base_delay seconds between tests when nothing is adapted (the runner's -f)
+        @param min_delay shortest delay while results deviate (default:base_delay / 4)
+        @param max_delay longest delay while results are stable (default:base_delay * 4)
+        @param adaptive False to keep base_delay and only enforce the budgets (default:True)
+        @param daily_budget bytes tests may use per day (default:None, no limit)
+        @param monthly_budget bytes tests may use per calendar month (default:None, no limit)
+        @param threshold relative deviation from the baseline that counts as unusual (default:0.25)
+        @param alpha weight of a new result in the moving baseline (default:0.2)
+        @param backoff factor the delay grows by after a stable result (default:1.5)
+        @param warmup results the baseline needs before the delay adapts, until then tests run every
+                      base_delay (a failed test still shortens the delay) (default:3)
+        @param failed_bytes bytes charged to the budgets for a failed test (default:0)
+        """
+        super(AdaptiveScheduler, self).__init__()
+        self.base_delay = base_delay
+        self.min_delay = min_delay if min_delay is not None else base_delay / 4.0
+        self.max_delay = max_delay if max_delay is not None else base_delay * 4.0
+        self.adaptive = adaptive
+        self.daily_budget = daily_budget
+        self.monthly_budget = monthly_budget
+        self.threshold = threshold
+        self.alpha = alpha
+        self.backoff = backoff
+        self.warmup = warmup
+        self.failed_bytes = failed_bytes
+
+        self.delay = float(base_delay)
+        self.baseline = {}
+        self.baseline_count = 0
+        self.test_bytes = None
+        self.day = None
+        self.month = None
+        self.day_bytes = 0
+        self.month_bytes = 0
+
+    def reset(self, base_delay):
+        """Start over from a new base delay (ie after the runner reloaded its config)."""
+        self.min_delay = self.min_delay * base_delay / self.base_delay
+        self.max_delay = self.max_delay * base_delay / self.base_delay
+        self.base_delay = base_delay
+        self.delay = float(base_delay)
+
+    def seed(self, events):
+        """
+        Restore the data used so far this month from earlier decisions.
+
+        @param events schedule events saved to the store, see SpeedStore events
+        """
+        for event in sorted(events, key=lambda event: event["start"]):
+            self._count_bytes(event["start"], event.get("bytes") or 0)
+            if event.get("bytes"):
+                self._update_test_bytes(event["bytes"])
+
+    def seed_baseline(self, pairs):
+        """
+        Start the baseline from earlier results so the first tests of a run are judged against it.
+
+        @param pairs the latest results in the store as sorted (timestamp, result) pairs, see SpeedStore tail
+        """
+        for _, result in pairs:
+            self._deviation(result)
+
+    def _count_bytes(self, timestamp, used):
+        """Add the bytes of a test to the daily and monthly totals."""
+        day, month = timestamp[:10], timestamp[:7]
+        if day != self.day:
+            self.day, self.day_bytes = day, 0
+        if month != self.month:
+            self.month, self.month_bytes = month, 0
+        self.day_bytes += used
+        self.month_bytes += used
+
+    def _update_test_bytes(self, used):
+        """Keep a moving average of the bytes of a test."""
+        if self.test_bytes is None:
+            self.test_bytes = float(used)
+        else:
+            self.test_bytes += self.alpha * (used - self.test_bytes)
+
+    def _deviation(self, result):
+        """Return the largest relative deviation of the result from the baseline and update the baseline."""
+        if "error" in result:
+            return float("inf")
+        deviation = 0.0
+        if any(result.get(metric) is not None for metric in ("download", "upload", "ping")):
+            self.baseline_count += 1
+        for metric in ("download", "upload", "ping"):
+            value = result.get(metric)
+            if value is None:
+                continue
+            baseline = self.baseline.get(metric)
+            if baseline:
+                deviation = max(deviation, abs(value - baseline) / baseline)
+                # Unusual results barely move the baseline so an incident does not become the new normal.
+                weight = self.alpha if deviation <= self.threshold else self.alpha / 4
+                self.baseline[metric] = baseline + weight * (value - baseline)
+            else:
+                self.baseline[metric] = float(value)
+        return deviation
+
+    def _budget_delay(self, now, budget, used, period_end):
+        """Return the smallest delay that keeps the rest of a period within budget."""
+        remaining = budget - used
+        seconds_left = max(1.0, (period_end - now).total_seconds())
+        if remaining < self.test_bytes:
+            return seconds_left + 1
+        return seconds_left / (remaining / self.test_bytes)
+
+    def next_delay(self, timestamp, result):
+        """
+        Decide how long to wait after a test.
+
+        @param timestamp "%Y-%m-%d %H:%M:%S" of the test
+        @param result its result dictionary
+        @retval (delay in seconds, schedule event)
+        """
+        now = datetime.datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S")
+        used = test_bytes(result)
+        if used is None:
+            # A failed test moved little or no data, charging a whole test would starve the budget
+            used = int(self.failed_bytes)
+        else:
+            self._update_test_bytes(used)
+        self._count_bytes(timestamp, used)
+
+        deviation = self._deviation(result)
+        # The baseline counts this result too, it has to have had warmup results before it.
+        warm = self.baseline_count > self.warmup
+        if not self.adaptive:
+            reason = "fixed"
+            self.delay = float(self.base_delay)
+        elif deviation > self.threshold and (warm or deviation == float("inf")):
+            reason = "deviation"
+            self.delay = max(self.min_delay, self.delay / 2.0)
+        elif not warm:
+            reason = "warmup"
+            self.delay = float(self.base_delay)
+        else:
+            reason = "stable"
+            self.delay = min(self.max_delay, self.delay * self.backoff)
+        delay = self.delay
+
+        if self.test_bytes:
+            if self.daily_budget is not None:
+                day_end = datetime.datetime(now.year, now.month, now.day) + datetime.timedelta(days=1)
+                budget_delay = self._budget_delay(now, self.daily_budget, self.day_bytes, day_end)
+                if budget_delay > delay:
+                    delay, reason = budget_delay, "daily budget"
+            if self.monthly_budget is not None:
+                days = calendar.monthrange(now.year, now.month)[1]
+                month_end = datetime.datetime(now.year, now.month, 1) + datetime.timedelta(days=days)
+                budget_delay = self._budget_delay(now, self.monthly_budget, self.month_bytes, month_end)
+                if budget_delay > delay:
+                    delay, reason = budget_delay, "monthly budget"
+
+        event = {
+            "kind": "schedule",
+            "start": timestamp,
+            "end": (now + datetime.timedelta(seconds=delay)).strftime("%Y-%m-%d %H:%M:%S"),
+            "delay": delay,
+            "reason": reason,
+            "deviation": None if deviation == float("inf") else deviation,
+            "bytes": used,
+            "day_bytes": self.day_bytes,
+            "month_bytes": self.month_bytes
+        }
+        return delay, event
@@ -0,0 +1,952 @@
+"""
+Storage backends for SpeedTester results.
+
+A store is selected with a URI, uris name paths like SQLAlchemy does (three slashes then the path):
+    speedresults.json               -> JsonStore (the original flat json file)
+    json:///results.json            -> JsonStore, results.json relative to the working directory
+    sqlite:///results.db            -> SqliteStore, results.db relative to the working directory
+    sqlite:////path/to/results.db   -> SqliteStore, the absolute path /path/to/results.db
+    /path/to/results.db             -> SqliteStore (.db, .sqlite, .sqlite3)
+    http://collector:8080           -> HttpStore (read only, the store behind a SpeedCollector)
+
+Every store hands back results as (timestamp, result) pairs sorted by their
+"%Y-%m-%d %H:%M:%S" timestamp, so DrawSpeed does not care where the data came from.
+Pairs rather than a dictionary because probes pushing to one collector can measure
+at the same second; dict(pairs) is the shape the json file always had.
+Speeds are in bits/s and ping in ms; results saved before units were normalized
+("95.3 Mbit/s") are converted on load.
+
+The sqlite store runs in WAL mode so a `runner.py draw` can read while a
+runner is writing, and several runners can share one database. Runners sharing a
+json file take turns through a lock file next to it (on nix only).
+Results pushed to a SpeedCollector carry the name of the probe that measured them.
+"""
+__author__ = "Paul Pfeffer"
+
+import contextlib
+import errno
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# os.rename will not overwrite an existing file on windows, os.replace (python 3.3+) does.
+_replace = getattr(os, "replace", os.rename)
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlencode
+except ImportError:  # python 2
+    from urllib2 import Request, urlopen
+    from urllib import urlencode
+
+import SpeedParser
+import SpeedRetention
+
+# Keys of a result that get their own column in the sqlite store.
+# Anything else a result carries is kept in the "extra" json column.
+SAMPLE_COLUMNS = ["Provider", "ip_address", "ping", "download", "upload", "ssid", "all_info", "probe"]
+
+SAMPLE_FIELDS = "timestamp, provider, ip_address, ping, download, upload, ssid, all_info, extra, probe"
+SELECT_SAMPLES = "SELECT " + SAMPLE_FIELDS + " FROM samples"
+INSERT_SAMPLE = "INSERT INTO samples (" + SAMPLE_FIELDS + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Length of the timestamp prefix SqliteStore.aggregate groups by.
+SUMMARY_WIDTHS = {"minute": 16, "hour": 13, "day": 10, "month": 7}
+
+# Times a json compaction starts over because a flush replaced the file meanwhile.
+COMPACT_ATTEMPTS = 3
+
+
+def open_store(uri, logger=None):
+    """
+    Open the store described by uri.
+
+    @param uri a path or a json:/// / sqlite:/// / http:// uri, see the module docstring
+    @param logger optional logger
+    @retval JsonStore, SqliteStore or HttpStore
+    @throws ValueError for a json or sqlite uri without a path
+    """
+    if uri.startswith("http://") or uri.startswith("https://"):
+        return HttpStore(uri, logger)
+    for scheme, store_class in (("sqlite://", SqliteStore), ("json://", JsonStore)):
+        if uri.startswith(scheme):
+            # The third slash separates the (empty) host from the path, a fourth one makes the path absolute
+            path = uri[len(scheme):]
+            path = path[1:] if path.startswith("/") else path
+            if not path:
+                raise ValueError("{0} does not name a file. ie) {1}/results".format(uri, scheme))
+            return store_class(path, logger)
+    if os.path.splitext(uri)[1].lower() in (".db", ".sqlite", ".sqlite3"):
+        return SqliteStore(uri, logger)
+    return JsonStore(uri, logger)
+
+
+def _write_atomic(path, content):
+    """Replace path with content so readers see either the old or the new file, never a partial one."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".speedresults", dir=directory)
+    try:
+        # mkstemp creates the file readable by its owner only, keep the mode of the file being replaced
+        os.chmod(tmp_path, os.stat(path).st_mode if os.path.exists(path) else 0o644)
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        _replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def _compact_stats():
+    """Return the counts every store's compact reports."""
+    return {"aggregated": 0, "aggregates": 0, "trimmed": 0, "events": 0}
+
+
+def import_json(json_path, store):
+    """
+    Copy every result of a json results file into store.
+
+    Timestamps already present in the store are skipped so an import can be re-run.
+
+    @param json_path path to an existing speedresults.json
+    @param store the destination store
+    @retval number of results imported
+    """
+    with open(json_path) as f:
+        results = json.load(f)
+    existing = set(store.timestamps())
+    count = 0
+    for timestamp in sorted(results):
+        if timestamp in existing:
+            continue
+        store.append(timestamp, SpeedParser.normalize_result(results[timestamp]))
+        count += 1
+    store.flush()
+    return count
+
+
+class JsonStore(object):
+    """Results kept in a single json file."""
+
+    def __init__(self, path, logger=None):
+        """
+        Initialize JsonStore.
+
+        @param path path to the json file
+        @param logger optional logger
+        """
+        super(JsonStore, self).__init__()
+        self.path = path
+        self.events_path = path + ".events"
+        self.logger = logger
+        self.pending = {}
+        self.pending_events = []
+        # Held while the file is replaced, so a background compaction and flush never overwrite each other
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Hold the lock while the file is read and replaced.
+
+        On nix an exclusive lock on a file next to the results also keeps other processes sharing the file
+        (another runner, runner.py compact) from replacing it between a read and a write.
+        """
+        with self.lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.sidecar_path("lock"), 'a') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _read(self):
+        """
+        Return the results currently on disk.
+
+        @retval dictionary of results, empty when there is no file yet
+        @throws IOError or ValueError when the file exists but cannot be read or is not a results file,
+                so a write never replaces results it could not read
+        """
+        try:
+            f = open(self.path)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                return {}
+            raise
+        with f:
+            try:
+                results = json.load(f)
+            except ValueError as e:
+                raise ValueError("{0} is not a json results file: {1}".format(self.path, e))
+        if not isinstance(results, dict):
+            raise ValueError("{0} is not a json results file".format(self.path))
+        for result in results.values():
+            SpeedParser.normalize_result(result)
+        return results
+
+    def load(self):
+        """Return every result including the ones not yet flushed as sorted (timestamp, result) pairs."""
+        results = self._read()
+        results.update(self.pending)
+        return sorted(results.items())
+
+    def tail(self, count):
+        """Return the latest count results as sorted (timestamp, result) pairs, see load."""
+        return self.load()[-count:] if count > 0 else []
+
+    def timestamps(self):
+        """Return the timestamps of every stored result."""
+        return [timestamp for timestamp, _ in self.load()]
+
+    def revision(self):
+        """Return a string that changes whenever the file on disk changes."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return "json:missing"
+        return "json:{0}:{1}".format(stat.st_size, stat.st_mtime)
+
+    def sidecar_path(self, name):
+        """Return the path of a cache file kept next to the results file."""
+        return "{0}.{1}".format(self.path, name)
+
+    @staticmethod
+    def _last_result_end(f, size):
+        """Return the offset just past the last result in the file, or None if it is not a json object."""
+        block = min(size, 4096)
+        f.seek(size - block)
+        tail = f.read(block).rstrip()
+        if not tail.endswith(b"}"):
+            return None
+        rest = tail[:-1].rstrip()
+        if not rest.endswith(b"}"):
+            return None
+        return size - block + len(rest)
+
+    def changes_since(self, token):
+        """
+        Tell a cache what changed in the file since token.
+
+        Writes keep results sorted by timestamp so new results land right before the closing brace.
+        If the file up to the end of the last result seen is unchanged (same sha1) only what
+        follows is parsed, otherwise the whole file is.
+
+        @param token what an earlier call returned or None
+        @retval (token, results, rebuild) results is a sorted list of (timestamp, result).
+                It holds every result when rebuild is True, only the new ones otherwise
+                and is None when nothing changed.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return {"size": None}, [], True
+        if token and token.get("size") == stat.st_size and token.get("mtime") == stat.st_mtime:
+            return token, None, False
+        with open(self.path, 'rb') as f:
+            end = self._last_result_end(f, stat.st_size)
+            new_token = {"size": stat.st_size, "mtime": stat.st_mtime, "end": end, "sha1": None}
+            digest = hashlib.sha1()
+            if end is not None and token and token.get("end") and token["end"] <= end:
+                f.seek(0)
+                remaining = token["end"]
+                while remaining:
+                    chunk = f.read(min(remaining, 1 << 20))
+                    digest.update(chunk)
+                    remaining -= len(chunk)
+                if digest.hexdigest() == token["sha1"]:
+                    suffix = f.read()
+                    digest.update(suffix[:end - token["end"]])
+                    new_token["sha1"] = digest.hexdigest()
+                    suffix = suffix.decode("utf-8").strip()
+                    if suffix == "}":
+                        return new_token, [], False
+                    if suffix.startswith(","):
+                        results = json.loads("{" + suffix[1:])
+                        return new_token, [(timestamp, SpeedParser.normalize_result(results[timestamp]))
+                                           for timestamp in sorted(results)], False
+            f.seek(0)
+            content = f.read()
+        if end is not None:
+            new_token["sha1"] = hashlib.sha1(content[:end]).hexdigest()
+        try:
+            results = json.loads(content.decode("utf-8"))
+        except ValueError as e:
+            raise ValueError("{0} is not a json results file: {1}".format(self.path, e))
+        return new_token, [(timestamp, SpeedParser.normalize_result(results[timestamp]))
+                           for timestamp in sorted(results)], True
+
+    def query(self, start=None, end=None, **filters):
+        """
+        Return the results between start and end (inclusive) matching filters.
+
+        @param start "%Y-%m-%d %H:%M:%S" or a prefix of it (default:None)
+        @param end "%Y-%m-%d %H:%M:%S" or a prefix of it (default:None)
+        @param filters key value pairs results must match. ie) ssid="home"
+        @retval list of (timestamp, result) sorted by timestamp
+        """
+        return [(timestamp, result) for timestamp, result in self.load()
+                if not (start and timestamp < start) and not (end and timestamp[:len(end)] > end) and
+                not any(result.get(key) != val for key, val in filters.items())]
+
+    def append(self, timestamp, result):
+        """Queue a result to be written on the next flush."""
+        self.pending[timestamp] = result
+
+    def append_event(self, event):
+        """Queue an event (ie an OutageDetector interval) to be written on the next flush."""
+        self.pending_events.append(event)
+
+    def events(self, kind=None, start=None, end=None):
+        """
+        Return events, events are kept one json object per line next to the results file.
+
+        @param kind only return events of this kind. ie) schedule (default:None)
+        @param start only return events starting at or after start (default:None)
+        @param end only return events starting at or before end, see query (default:None)
+        """
+        try:
+            with open(self.events_path) as f:
+                events = [json.loads(line) for line in f if line.strip()]
+        except (IOError, OSError):
+            events = []
+        return [event for event in events + self.pending_events
+                if (kind is None or event.get("kind") == kind) and
+                (start is None or event.get("start") >= start) and
+                (end is None or event.get("start")[:len(end)] <= end)]
+
+    def flush(self, pretty=False):
+        """
+        Merge queued results with the file on disk and atomically replace it.
+
+        The file is re-read right before it is written while holding the lock, see _locked.
+        When it exists but cannot be read nothing is written and the results stay queued.
+
+        @param pretty should be True if you want to read the result file yourself. (default=False)
+        @throws IOError or ValueError when the file on disk cannot be read, see _read
+        """
+        with self._locked():
+            if self.pending_events:
+                with open(self.events_path, 'a') as f:
+                    for event in self.pending_events:
+                        f.write(json.dumps(event, sort_keys=True) + "\n")
+                self.pending_events = []
+            if not self.pending:
+                return
+            results = self._read()
+            results.update(self.pending)
+            self._write(results, pretty)
+            self.pending = {}
+
+    def _write(self, results, pretty=False):
+        """Atomically replace the file with results."""
+        if pretty:
+            _write_atomic(self.path, json.dumps(results, sort_keys=True, indent=4, separators=(',', ': ')))
+        else:
+            _write_atomic(self.path, json.dumps(results, sort_keys=True))
+
+    def compact(self, policy, now=None):
+        """
+        Apply a retention policy, see SpeedRetention.
+
+        The compacted file is built from a snapshot without holding the lock. It only replaces the file
+        when no flush happened meanwhile (otherwise it starts over), so the writer waits for a rename at most.
+        Only when flushes keep winning COMPACT_ATTEMPTS times does the compaction hold the lock throughout.
+
+        @param policy SpeedRetention.RetentionPolicy
+        @param now datetime to measure from (default:None, the current time)
+        @retval dictionary with the number of results aggregated, aggregates made, results trimmed of
+                all_info and events dropped
+        """
+        raw_cutoff, info_cutoff = policy.cutoffs(now)
+        stats = _compact_stats()
+        for _ in range(COMPACT_ATTEMPTS):
+            revision = self.revision()
+            results, counts = self._compacted(policy.bucket, raw_cutoff, info_cutoff)
+            if not any(counts.values()):
+                break
+            with self._locked():
+                if self.revision() != revision:
+                    continue
+                self._write(results)
+            stats.update(counts)
+            break
+        else:
+            # A flush replaced the file every time, compact while holding the lock instead
+            with self._locked():
+                results, counts = self._compacted(policy.bucket, raw_cutoff, info_cutoff)
+                if any(counts.values()):
+                    self._write(results)
+            stats.update(counts)
+        schedule_cutoff = policy.schedule_cutoff(now)
+        if schedule_cutoff:
+            stats["events"] = self._drop_schedule_events(schedule_cutoff)
+        return stats
+
+    def _compacted(self, bucket, raw_cutoff, info_cutoff):
+        """
+        Return the results on disk with a retention policy applied.
+
+        @retval (results, dictionary with the number of results aggregated, aggregates made and results trimmed)
+        """
+        results = self._read()
+        old = [(timestamp, result) for timestamp, result in sorted(results.items())
+               if raw_cutoff and timestamp < raw_cutoff and not SpeedRetention.is_aggregate(result)]
+        for timestamp, _ in old:
+            del results[timestamp]
+        aggregates = SpeedRetention.aggregate(old, bucket)
+        results.update(aggregates)
+        trimmed = 0
+        if info_cutoff:
+            for timestamp, result in results.items():
+                if timestamp < info_cutoff and "all_info" in result:
+                    results[timestamp] = SpeedRetention.drop_info(result)
+                    trimmed += 1
+        return results, {"aggregated": len(old), "aggregates": len(aggregates), "trimmed": trimmed}
+
+    def _drop_schedule_events(self, cutoff):
+        """Drop schedule events that start before cutoff, return how many were dropped."""
+        with self._locked():
+            try:
+                with open(self.events_path) as f:
+                    lines = [line for line in f if line.strip()]
+            except (IOError, OSError):
+                return 0
+            kept = []
+            for line in lines:
+                event = json.loads(line)
+                if event.get("kind") != "schedule" or event.get("start") >= cutoff:
+                    kept.append(line)
+            if len(kept) < len(lines):
+                _write_atomic(self.events_path, "".join(kept))
+        return len(lines) - len(kept)
+
+    def close(self):
+        """Nothing to release for a json file."""
+        pass
+
+
+class SqliteStore(object):
+    """Results kept in a sqlite database with one row per sample."""
+
+    def __init__(self, path, logger=None):
+        """
+        Open (and create if needed) the database.
+
+        @param path path to the database file
+        @param logger optional logger
+        """
+        super(SqliteStore, self).__init__()
+        self.path = path
+        self.logger = logger
+        self.pending = []
+        self.pending_events = []
+        self.conn = sqlite3.connect(path, timeout=30)
+        # Readers never block the writer and the writer never blocks readers.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_schema()
+
+    def _create_schema(self):
+        """Create tables and indexes that do not exist yet."""
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS samples ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " timestamp TEXT NOT NULL,"
+                " provider TEXT,"
+                " ip_address TEXT,"
+                " ping REAL,"
+                " download REAL,"
+                " upload REAL,"
+                " ssid TEXT,"
+                " all_info TEXT,"
+                " extra TEXT,"
+                " probe TEXT)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS samples_timestamp ON samples (timestamp)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS samples_ssid ON samples (ssid, timestamp)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS samples_provider ON samples (provider, timestamp)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " kind TEXT NOT NULL,"
+                " start TEXT,"
+                " end TEXT,"
+                " event TEXT NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS events_start ON events (start)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS events_kind ON events (kind, start)")
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version < 1:
+            self._normalize_units()
+        if version < 2:
+            self._add_probe()
+
+    def _normalize_units(self):
+        """
+        Convert speeds saved as text before units were normalized ("95.3 Mbit/s") to numbers (schema version 1).
+
+        Values that cannot be converted end up in the extra column, see SpeedParser.normalize_result.
+        """
+        with self.conn:
+            rows = self.conn.execute(
+                "SELECT id, ping, download, upload, extra FROM samples"
+                " WHERE typeof(ping) = 'text' OR typeof(download) = 'text' OR typeof(upload) = 'text'").fetchall()
+            for row_id, ping, download, upload, extra in rows:
+                result = dict(json.loads(extra) if extra else {}, ping=ping, download=download, upload=upload)
+                SpeedParser.normalize_result(result)
+                extra = dict((key, val) for key, val in result.items() if key not in SAMPLE_COLUMNS)
+                self.conn.execute("UPDATE samples SET ping = ?, download = ?, upload = ?, extra = ? WHERE id = ?",
+                                  (result["ping"], result["download"], result["upload"],
+                                   json.dumps(extra) if extra else None, row_id))
+            self.conn.execute("PRAGMA user_version = 1")
+
+    def _add_probe(self):
+        """Add the column naming the probe a result was pushed from (schema version 2)."""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(samples)")]
+        with self.conn:
+            if "probe" not in columns:
+                self.conn.execute("ALTER TABLE samples ADD COLUMN probe TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS samples_probe ON samples (probe, timestamp)")
+            self.conn.execute("PRAGMA user_version = 2")
+
+    @staticmethod
+    def _to_row(timestamp, result):
+        """Turn a result dictionary into a samples row."""
+        extra = dict((key, val) for key, val in result.items() if key not in SAMPLE_COLUMNS)
+        return (
+            timestamp,
+            result.get("Provider"),
+            result.get("ip_address"),
+            result.get("ping"),
+            result.get("download"),
+            result.get("upload"),
+            result.get("ssid"),
+            result.get("all_info"),
+            json.dumps(extra) if extra else None,
+            result.get("probe")
+        )
+
+    @staticmethod
+    def _from_row(row):
+        """Turn a samples row back into (timestamp, result)."""
+        timestamp, provider, ip_addr, ping, download, upload, ssid, all_info, extra, probe = row
+        result = {
+            "Provider": provider,
+            "ip_address": ip_addr,
+            "ping": ping,
+            "download": download,
+            "upload": upload,
+            "ssid": ssid,
+            "all_info": all_info
+        }
+        if extra:
+            result.update(json.loads(extra))
+        if probe is not None:
+            result["probe"] = probe
+        return timestamp, result
+
+    def _select(self, start=None, end=None, filters=None):
+        """Build the where clause of query."""
+        clauses = []
+        params = []
+        if start:
+            clauses.append("timestamp >= ?")
+            params.append(start)
+        if end:
+            # Compare on the prefix so end="2017-01-02" includes that whole day.
+            clauses.append("substr(timestamp, 1, ?) <= ?")
+            params.extend([len(end), end])
+        for key, val in (filters or {}).items():
+            column = "provider" if key == "Provider" else key
+            if column not in ("provider", "ip_address", "ssid", "probe"):
+                raise ValueError("Cannot filter on {0}".format(key))
+            clauses.append("{0} = ?".format(column))
+            params.append(val)
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        return where, params
+
+    def load(self):
+        """Return every result including the ones not yet flushed, see query."""
+        return self.query()
+
+    def tail(self, count):
+        """Return the latest count results as sorted (timestamp, result) pairs, reading only their rows."""
+        self.flush()
+        rows = self.conn.execute(SELECT_SAMPLES + " ORDER BY timestamp DESC, id DESC LIMIT ?", (max(0, count),))
+        return [self._from_row(row) for row in reversed(rows.fetchall())]
+
+    def timestamps(self):
+        """Return the timestamps of every stored result."""
+        rows = self.conn.execute("SELECT timestamp FROM samples")
+        return [row[0] for row in rows] + [row[0] for row in self.pending]
+
+    def revision(self):
+        """Return a string that changes whenever samples are added or removed."""
+        self.flush()
+        last_id, count = self.conn.execute("SELECT MAX(id), COUNT(*) FROM samples").fetchone()
+        return "sqlite:{0}:{1}".format(last_id or 0, count)
+
+    def sidecar_path(self, name):
+        """Return the path of a cache file kept next to the database."""
+        return "{0}.{1}".format(self.path, name)
+
+    def changes_since(self, token):
+        """
+        Tell a cache what changed in the database since token.
+
+        Rows only get new ids so when every row counted since token has an id past the
+        last one seen only those rows are read, otherwise (rows were removed) all of them are.
+
+        @param token what an earlier call returned or None
+        @retval see JsonStore.changes_since
+        """
+        new_token, after, rebuild = self.changed_rows(token)
+        if after is None:
+            return new_token, None, False
+        pairs, _ = self.rows_after(after, new_token["last_id"])
+        return new_token, sorted(pairs, key=lambda pair: pair[0]), rebuild
+
+    def changed_rows(self, token):
+        """
+        Find the rows that changed since token, see changes_since.
+
+        @param token what an earlier call (or changes_since) returned or None
+        @retval (token, after, rebuild) the changes are the rows with ids past after up to token["last_id"],
+                after is None when nothing changed
+        """
+        self.flush()
+        last_id, count = self.conn.execute("SELECT MAX(id), COUNT(*) FROM samples").fetchone()
+        new_token = {"last_id": last_id or 0, "count": count}
+        if token and token.get("last_id") == new_token["last_id"] and token.get("count") == count:
+            return token, None, False
+        if token and token.get("last_id") is not None:
+            added = self.conn.execute("SELECT COUNT(*) FROM samples WHERE id > ?", (token["last_id"],)).fetchone()[0]
+            if token["count"] + added == count:
+                return new_token, token["last_id"], False
+        return new_token, 0, True
+
+    def rows_after(self, after, last_id=None, limit=None):
+        """
+        Return rows in id order, a page at a time when limit is given.
+
+        @param after only rows with an id past this one
+        @param last_id only rows up to this id (default:None, every row)
+        @param limit most rows returned (default:None, every row)
+        @retval (list of (timestamp, result), id to pass as after for the next page or None after the last page)
+        """
+        self.flush()
+        return self._page(" WHERE id > ?" + (" AND id <= ?" if last_id is not None else ""),
+                          [after] + ([last_id] if last_id is not None else []), limit)
+
+    def _page(self, where, params, limit):
+        """Run a select of samples ordered by id, see rows_after."""
+        rows = self.conn.execute("SELECT id, " + SAMPLE_FIELDS + " FROM samples" + where + " ORDER BY id" +
+                                 (" LIMIT ?" if limit else ""), params + ([limit] if limit else [])).fetchall()
+        following = rows[-1][0] if limit and len(rows) == limit else None
+        return [self._from_row(row[1:]) for row in rows], following
+
+    def query(self, start=None, end=None, **filters):
+        """
+        Return the results between start and end (inclusive) matching filters.
+
+        @param start "%Y-%m-%d %H:%M:%S" or a prefix of it (default:None)
+        @param end "%Y-%m-%d %H:%M:%S" or a prefix of it (default:None)
+        @param filters key value pairs results must match. ie) ssid="home"
+        @retval list of (timestamp, result) sorted by timestamp
+        """
+        self.flush()
+        where, params = self._select(start, end, filters)
+        rows = self.conn.execute(SELECT_SAMPLES + where + " ORDER BY timestamp, id", params)
+        return [self._from_row(row) for row in rows]
+
+    def query_page(self, after=0, limit=None, start=None, end=None, **filters):
+        """
+        Return a page of what query returns, in id order, for readers that should not hold it all at once.
+
+        @param after only rows with an id past this one, what the previous page returned (default:0)
+        @param limit most rows returned (default:None, every row)
+        @param start see query (default:None)
+        @param end see query (default:None)
+        @param filters see query
+        @retval see rows_after
+        """
+        self.flush()
+        where, params = self._select(start, end, filters)
+        where = (where + " AND" if where else " WHERE") + " id > ?"
+        return self._page(where, params + [after], limit)
+
+    def aggregate(self, metric, bucket="day", start=None, end=None, **filters):
+        """
+        Summarize a metric per time bucket inside sqlite instead of reading every row.
+
+        Failed tests are left out. Results compacted by a retention policy count once per aggregate.
+
+        @param metric one of ping, download or upload
+        @param bucket one of SUMMARY_WIDTHS (default:day)
+        @param start see query (default:None)
+        @param end see query (default:None)
+        @param filters see query
+        @retval list of (bucket, count, min, avg, max) tuples ordered by bucket
+        """
+        if metric not in SpeedRetention.METRICS:
+            raise ValueError("Cannot aggregate {0}".format(metric))
+        if bucket not in SUMMARY_WIDTHS:
+            raise ValueError("Cannot summarize per {0}. Choose from {1}".format(bucket, sorted(SUMMARY_WIDTHS)))
+        self.flush()
+        where, params = self._select(start, end, filters)
+        where = (where + " AND " if where else " WHERE ") + metric + " IS NOT NULL"
+        return self.conn.execute(
+            "SELECT substr(timestamp, 1, {width}) AS bucket, COUNT(*), MIN({m}), AVG({m}), MAX({m})"
+            " FROM samples{where} GROUP BY bucket ORDER BY bucket".format(
+                width=SUMMARY_WIDTHS[bucket], m=metric, where=where), params).fetchall()
+
+    def append(self, timestamp, result):
+        """Queue a result to be written on the next flush."""
+        self.pending.append(self._to_row(timestamp, result))
+
+    def insert_new(self, pairs):
+        """
+        Insert results right away, skipping the ones already stored for the same probe and timestamp.
+
+        Used by SpeedCollector so a batch that is pushed again after a lost reply is not stored twice.
+
+        @param pairs list of (timestamp, result)
+        @retval number of results inserted
+        """
+        rows = [row + (row[-1], row[0]) for row in (self._to_row(timestamp, result) for timestamp, result in pairs)]
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO samples (" + SAMPLE_FIELDS + ") SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?"
+                " WHERE NOT EXISTS (SELECT 1 FROM samples WHERE probe IS ? AND timestamp = ?)", rows)
+        return self.conn.total_changes - before
+
+    def append_event(self, event):
+        """Queue an event (ie an OutageDetector interval) to be written on the next flush."""
+        self.pending_events.append((event.get("kind"), event.get("start"), event.get("end"),
+                                    json.dumps(event, sort_keys=True)))
+
+    def events(self, kind=None, start=None, end=None):
+        """
+        Return events ordered by start.
+
+        @param kind see JsonStore.events (default:None)
+        @param start see JsonStore.events (default:None)
+        @param end see JsonStore.events (default:None)
+        """
+        self.flush()
+        clauses = []
+        params = []
+        if kind is not None:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if start is not None:
+            clauses.append("start >= ?")
+            params.append(start)
+        if end is not None:
+            clauses.append("substr(start, 1, ?) <= ?")
+            params.extend([len(end), end])
+        where = " WHERE " + " AND ".join(clauses) if clauses else ""
+        rows = self.conn.execute("SELECT event FROM events" + where + " ORDER BY start, id", params)
+        return [json.loads(row[0]) for row in rows]
+
+    def flush(self, pretty=False):
+        """
+        Insert every queued result and event in a single transaction.
+
+        @param pretty ignored, kept so every store flushes the same way.
+        """
+        if not self.pending and not self.pending_events:
+            return
+        with self.conn:
+            self.conn.executemany(INSERT_SAMPLE, self.pending)
+            self.conn.executemany("INSERT INTO events (kind, start, end, event) VALUES (?, ?, ?, ?)",
+                                  self.pending_events)
+        self.pending = []
+        self.pending_events = []
+
+    def compact(self, policy, now=None):
+        """
+        Apply a retention policy, see SpeedRetention.
+
+        Raw results are aggregated one day per transaction so a writer never waits long. Compaction uses a
+        connection of its own and can run in another thread. Freed pages are reused by later inserts, so
+        the file stops growing once it holds raw_days of results.
+
+        @param policy SpeedRetention.RetentionPolicy
+        @param now datetime to measure from (default:None, the current time)
+        @retval see JsonStore.compact
+        """
+        raw_cutoff, info_cutoff = policy.cutoffs(now)
+        stats = _compact_stats()
+        # Aggregates keep their summary in the extra column, see _to_row
+        raw = "(extra IS NULL OR instr(extra, '\"aggregate\"') = 0)"
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            day = ""
+            while raw_cutoff:
+                first = conn.execute("SELECT MIN(timestamp) FROM samples WHERE timestamp >= ? AND timestamp < ?"
+                                     " AND " + raw, (day, raw_cutoff)).fetchone()[0]
+                if first is None:
+                    break
+                # "~" sorts after every time of a day
+                day, next_day = first[:10], first[:10] + "~"
+                with conn:
+                    rows = conn.execute(
+                        "SELECT id, " + SAMPLE_FIELDS + " FROM samples"
+                        " WHERE timestamp >= ? AND timestamp < ? AND timestamp < ? AND " + raw +
+                        " ORDER BY timestamp, id", (day, next_day, raw_cutoff)).fetchall()
+                    aggregates = SpeedRetention.aggregate([self._from_row(row[1:]) for row in rows], policy.bucket)
+                    conn.executemany("DELETE FROM samples WHERE id = ?", [(row[0],) for row in rows])
+                    conn.executemany(INSERT_SAMPLE, [self._to_row(timestamp, result)
+                                                     for timestamp, result in aggregates])
+                stats["aggregated"] += len(rows)
+                stats["aggregates"] += len(aggregates)
+                day = next_day
+            with conn:
+                if info_cutoff:
+                    stats["trimmed"] = conn.execute(
+                        "UPDATE samples SET all_info = NULL WHERE timestamp < ? AND all_info IS NOT NULL",
+                        (info_cutoff,)).rowcount
+                schedule_cutoff = policy.schedule_cutoff(now)
+                if schedule_cutoff:
+                    stats["events"] = conn.execute("DELETE FROM events WHERE kind = 'schedule' AND start < ?",
+                                                   (schedule_cutoff,)).rowcount
+        finally:
+            conn.close()
+        return stats
+
+    def close(self):
+        """Flush and close the connection."""
+        self.flush()
+        self.conn.close()
+
+
+class HttpStore(object):
+    """Read only view of the store behind a SpeedCollector, so `runner.py draw` can draw every probe."""
+
+    def __init__(self, url, logger=None, timeout=60):
+        """
+        Initialize HttpStore.
+
+        @param url the collector's address. ie) http://collector:8080
+        @param logger optional logger
+        @param timeout seconds to wait for the collector (default:60)
+        """
+        super(HttpStore, self).__init__()
+        self.url = url.rstrip("/")
+        self.logger = logger
+        self.timeout = timeout
+
+    def _request(self, path, params=None, body=None):
+        """GET (or POST body as json to) a collector path and return the decoded json reply."""
+        url = self.url + path
+        if params:
+            url += "?" + urlencode(dict((key, val) for key, val in params.items() if val is not None))
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request = Request(url, data=data, headers={"Accept-Encoding": "gzip", "Content-Type": "application/json"})
+        response = urlopen(request, timeout=self.timeout)
+        try:
+            content = response.read()
+            if response.info().get("Content-Encoding") == "gzip":
+                content = gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+        finally:
+            response.close()
+        return json.loads(content.decode("utf-8"))
+
+    def load(self):
+        """Return every result, see query."""
+        return self.query()
+
+    def tail(self, count):
+        """Return the latest count results, see JsonStore.tail."""
+        return self.load()[-count:] if count > 0 else []
+
+    def timestamps(self):
+        """Return the timestamps of every stored result."""
+        return [timestamp for timestamp, _ in self.load()]
+
+    def revision(self):
+        """Return a string that changes whenever the collector's store changes."""
+        return self._request("/revision")["revision"]
+
+    def sidecar_path(self, name):
+        """Return the path of a local cache file for this collector."""
+        digest = hashlib.md5(self.url.encode("utf-8")).hexdigest()[:12]
+        return os.path.join(tempfile.gettempdir(), "speedcollector-{0}.{1}".format(digest, name))
+
+    def changes_since(self, token):
+        """
+        Ask the collector's store what changed since token, see JsonStore.changes_since.
+
+        The collector answers a page at a time, see SqliteStore.changed_rows.
+        """
+        reply = self._request("/changes", body={"token": token})
+        if reply["pairs"] is None:
+            return reply["token"], None, False
+        rebuild = reply["rebuild"]
+        pairs = [tuple(pair) for pair in reply["pairs"]]
+        while reply["after"] is not None:
+            reply = self._request("/changes", body={"token": reply["token"], "after": reply["after"]})
+            pairs.extend(tuple(pair) for pair in reply["pairs"])
+        return reply["token"], sorted(pairs, key=lambda pair: pair[0]), rebuild
+
+    def query(self, start=None, end=None, **filters):
+        """Return the results between start and end (inclusive) matching filters, see SqliteStore.query."""
+        params = dict(filters, start=start, end=end, after=0)
+        pairs = []
+        while params["after"] is not None:
+            reply = self._request("/query", params)
+            pairs.extend(tuple(pair) for pair in reply["pairs"])
+            params["after"] = reply["after"]
+        return sorted(pairs, key=lambda pair: pair[0])
+
+    def events(self, kind=None, start=None, end=None):
+        """Return events ordered by start, see JsonStore.events."""
+        return self._request("/events", {"kind": kind, "start": start, "end": end})
+
+    def append(self, timestamp, result):
+        """Results reach a collector with SpeedExporter, not through its store."""
+        raise ValueError("{0} is read only, push results to it with runner.py run -push".format(self.url))
+
+    def append_event(self, event):
+        """See append."""
+        self.append(event.get("start"), event)
+
+    def compact(self, policy, now=None):
+        """See append, compact the collector's store with runner.py compact instead."""
+        raise ValueError("{0} is read only, compact the collector's store instead".format(self.url))
+
+    def flush(self, pretty=False):
+        """Nothing is ever queued."""
+        pass
+
+    def close(self):
+        """Nothing to release."""
+        pass
+
+
+def main():
+    """Example of how to use the stores."""
+    import sys
+
+    if len(sys.argv) != 3:
+        sys.exit("usage: SpeedStore.py speedresults.json sqlite:///speedresults.db")
+    store = open_store(sys.argv[2])
+    print("Imported {0} results".format(import_json(sys.argv[1], store)))
+    store.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,131 +1,153 @@
 """
 Runs a speed test to test internet speed.
 
-Results are written to a file called "speedresults.json".
+Results are written to a file called "speedresults.json" or any other
+store SpeedStore.open_store understands (ie sqlite:///speedresults.db).
 This script is best used with a cronjob, windows schedule or included runner script.
 
 pip install speedtest-cli
 """
 __author__ = "Paul Pfeffer"
 
-import json
 import os
-import re
 import subprocess
 import time
 
+import SpeedParser
+import SpeedStore
+
 
 def live_communicate(process, logger):
-    """Execute subprocess printing data when available."""
-    data_received = ""
-    while True:
-        line = process.stdout.readline()
-        if line != '':
-            logger.info(line.rstrip())
-            data_received += line.rstrip()
-        else:
-            break
-    return data_received
+    """
+    Execute subprocess printing data when available.
+
+    @param process a subprocess.Popen with stdout=PIPE and universal_newlines=True
+    @retval the output, one line per line printed
+    """
+    lines = []
+    for line in iter(process.stdout.readline, ""):
+        line = line.rstrip()
+        logger.info(line)
+        lines.append(line)
+    return "\n".join(lines)
 
 
 class SpeedTester(object):
     """Get the speed of Internet."""
 
-    def __init__(self, logger, results_file):
-        """Define needed regex and main results dictionary.
+    def __init__(self, logger, results_file, detector=None, output_format="text"):
+        """Define the speedtest command and open the store results are saved to.
 
         @param logger
-        @param results_file
+        @param results_file path or store uri, see SpeedStore.open_store
+        @param detector optional OutageDetector.DetectionEngine fed with every result
+        @param output_format output format to ask speedtest-cli for, see SpeedParser.FORMATS (default:text)
         """
         super(SpeedTester, self).__init__()
-        self.ipv4_regex = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"
-        self.results = {}
+        self.output_format = output_format
         self.logger = logger
         self.results_file = results_file
+        self.store = SpeedStore.open_store(results_file, logger)
+        self.detector = detector
+        self.process = None
+        self.cancelled = False
+        # (timestamp, result) of the latest test, earlier ones are only kept in the store
+        self.last_result = None
         if os.name == "nt":
-            self.speedtest_cmd = "speedtest.exe"
+            self.speedtest_cmd = ["speedtest.exe"] + SpeedParser.FORMAT_FLAGS[output_format]
         else:
             # assume nix
-            self.speedtest_cmd = "speedtest-cli"
+            self.speedtest_cmd = ["speedtest-cli"] + SpeedParser.FORMAT_FLAGS[output_format]
 
     def __del__(self):
         """Alert that class is being torn down."""
         self.logger.debug("Called __del__ method of SpeedTester")
 
     def get_previous_results(self):
-        """Add previous results from json."""
-        with open(self.results_file) as f:
-            try:
-                self.results = json.load(f)
-            except ValueError:
-                self.logger.critical("No json was loaded from speedresults.json")
+        """
+        Return the results saved in the store so far, they are read on every call and not kept.
+
+        @retval list of (timestamp, result) sorted by timestamp, see SpeedStore
+        """
+        return self.store.load()
 
     def run_test(self):
         """Execute speed test process and save results."""
         self.logger.info("Running Test..........")
+        self.cancelled = False
         speedtest_process = subprocess.Popen(
             self.speedtest_cmd,
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.process = speedtest_process
         speedtest_out = live_communicate(speedtest_process, logger=self.logger)
+        speedtest_process.wait()
+        self.process = None
+        if self.cancelled:
+            self.logger.info("Test was cancelled, nothing to save.")
+            return
 
         if os.name == "nt":
             speedtest_process = subprocess.Popen(
                 ["NETSH", "WLAN", "SHOW", "INTERFACE", "|", "findstr", "/r", "'^....SSID'"],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True
             )
             wlan_info_out, err = speedtest_process.communicate()
-            speedtest_out += wlan_info_out
+            speedtest_out += "\n" + wlan_info_out
 
         self.logger.info("Running Test Complete.")
         self.logger.info("Saving Results")
         self.parse_and_save_results(speedtest_out)
         self.logger.info("Saving Results Complete")
 
+    def cancel(self):
+        """Stop the test in progress (if any) without saving a result for it. Safe to call from any thread."""
+        self.cancelled = True
+        process = self.process
+        if process and process.poll() is None:
+            process.terminate()
+
     def parse_and_save_results(self, output):
         """
         Parse results into the available keys.
 
+        Speeds are saved in bits/s and ping in ms, see SpeedParser.
+
+        A test whose output cannot be parsed is saved as a failed result (with an "error" key)
+        so it shows up as an outage instead of stopping the runner.
+
         @param output the raw output from running speedtest.exe
         """
-        from_regex = r"Testing from (.+) \((%s)" % self.ipv4_regex
-        from_addr = re.search(from_regex, output)
-        provider = from_addr.group(1)
-        ip_addr = from_addr.group(2)
-        ping_regex = r"Hosted by.+?(\d+?.\d+?\sms)"
-        ping_time = re.search(ping_regex, output).group(1)
-        download_regex = "Download: (.+?/s)"
-        download_speed = re.search(download_regex, output).group(1)
-        upload_regex = "Upload: (.+?/s)"
-        upload_speed = re.search(upload_regex, output).group(1)
-
         try:
-            ssid_regex = r"SSID\s+: (.+\s)"
-            ssid_name = re.search(ssid_regex, output).group(1).strip()
-        except AttributeError:
+            result = SpeedParser.parse(output, self.output_format)
+        except SpeedParser.ParseError as e:
+            self.logger.error("Speed test failed: {0}".format(e))
+            result = {
+                "error": str(e),
+                "ssid": SpeedParser.parse_ssid(output),
+                "all_info": output
+            }
+        if result["ssid"] == "wired":
             self.logger.info("You have a wired connection")
-            ssid_name = "wired"
-        result = {
-            "Provider": provider,
-            "ip_address": ip_addr,
-            "ping": ping_time,
-            "download": download_speed,
-            "upload": upload_speed,
-            "ssid": ssid_name,
-            "all_info": output
-        }
-        self.results[time.strftime("%Y-%m-%d %H:%M:%S")] = result
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        self.last_result = (timestamp, result)
+        self.store.append(timestamp, result)
+        if self.detector:
+            for interval in self.detector.feed(timestamp, result):
+                self.logger.warning("Detected {kind} from {start} to {end}: {detail}".format(**interval))
+                self.store.append_event(interval)
 
     def write_results_to_file(self, pretty=False):
         """
-        Write the gathered results to a text file.
+        Write the gathered results to the store.
+
+        A store that cannot be read is left alone, the results stay queued until the next write.
 
         @param pretty should be True if you want to read the result file yourself. (default=False)
         """
-        with open(self.results_file, 'w') as f:
-            if pretty:
-                f.write(json.dumps(self.results, f, sort_keys=True, indent=4, separators=(',', ': ')))
-            else:
-                f.write(json.dumps(self.results, f))
+        try:
+            self.store.flush(pretty=pretty)
+        except (IOError, OSError, ValueError) as e:
+            self.logger.critical("Results were not saved, {0}".format(e))
 
 
 def main():
@@ -136,7 +158,7 @@ def main():
     logger = logging.getLogger(__name__)                       # Any logger should do
 
     tester = SpeedTester(logger, "speedresults.json")          # Create instance of class
-    tester.get_previous_results()                              # Optionally load previous results
+    logger.info("{0} results saved so far".format(len(tester.get_previous_results())))
     tester.run_test()                                          # Run the tests
     tester.write_results_to_file(pretty=True)                  # Save results
 
@@ -3,15 +3,28 @@ Run SpeedTester repetitively with a specified delay and duration.
 
 Details
 -------
-If you clear the process id file while the script is running it will stop the execution.
+Stop the runner with stop_runner.py (or SIGTERM). It finishes writing results before it exits.
+Start it with -socket to also run a test now, reload -configfile or ask for its status with stop_runner.py.
 """
 import argparse
+import json
 import logging
 import os
+import signal
+import socket
 import sys
+import threading
 import time
-import json
 
+import OutageDetector
+import RunnerControl
+import SpeedCache
+import SpeedCollector
+import SpeedExporter
+import SpeedParser
+import SpeedRetention
+import SpeedScheduler
+import SpeedStore
 import SpeedTester
 import DrawSpeed
 
@@ -29,28 +42,134 @@ def parse_cmd_line_options():
                             help='How often should we run.')
     run_parser.add_argument("-d", "--duration", nargs=2, default=[24, "hour"],
                             help="How long should we run. (default=%(default)s)")
-    run_parser.add_argument("-resultfile", default="speedresults.json",
-                            help="Location where results shouls be saved (default=%(default)s)")
-    run_parser.add_argument("-configfile")
+    run_parser.add_argument("-store", "-resultfile", dest="store", default="speedresults.json",
+                            help="File or store uri (ie sqlite:///speedresults.db) where results should be saved "
+                                 "(default=%(default)s)")
+    run_parser.add_argument("-sla", nargs=2, action="append", metavar=("METRIC", "LIMIT"),
+                            help="Report when a metric breaches a limit. ie) -sla download 20 (can be repeated)")
+    run_parser.add_argument("-format", default="text", choices=SpeedParser.FORMATS,
+                            help="Output format to ask speedtest-cli for. (default=%(default)s)")
+    run_parser.add_argument("-configfile",
+                            help="Json file with frequency and/or duration, re-read on reload. ie) {\"frequency\": [5, \"min\"]}")
     run_parser.add_argument("-pidfile")
+    run_parser.add_argument("-socket", help="Unix socket to accept stop, test, reload and status commands on")
+    run_parser.add_argument("-adaptive", action="store_true",
+                            help="Test more often while results stray from the usual and less often while stable")
+    run_parser.add_argument("-min-frequency", nargs=2, dest="min_frequency",
+                            help="Shortest wait between adaptive tests. (default=frequency / 4)")
+    run_parser.add_argument("-max-frequency", nargs=2, dest="max_frequency",
+                            help="Longest wait between adaptive tests. (default=frequency * 4)")
+    run_parser.add_argument("-budget-day", dest="budget_day",
+                            help="Data the tests may use per day. ie) 500MB")
+    run_parser.add_argument("-budget-month", dest="budget_month",
+                            help="Data the tests may use per calendar month. ie) 10GB")
+    run_parser.add_argument("-push", help="Also send results to a collector. ie) http://collector:8080")
+    run_parser.add_argument("-probe", default=socket.gethostname(),
+                            help="Name results are pushed under. (default=%(default)s)")
+    run_parser.add_argument("-spool",
+                            help="Directory results that could not be pushed wait in. (default=next to the store)")
+    add_retention_arguments(run_parser)
 
     # create the parser for the "draw" command
     draw_parser = subparsers.add_parser('draw', help='help for command_2')
-    draw_parser.add_argument("-resultfile", default="speedresults.json", help="Choose results file to draw.  (default=%(default)s)")
+    draw_parser.add_argument("-store", "-resultfile", dest="store", default="speedresults.json",
+                             help="Choose results file or store uri to draw.  (default=%(default)s)")
+    draw_parser.add_argument("-start", help="Only draw results from this time on. ie) 2017-01-31")
+    draw_parser.add_argument("-end", help="Only draw results up to this time. ie) 2017-02-28")
     draw_parser.add_argument("-type", default="pyplot", choices=["pyplot", "plotly"],
                              help="The type of graph to display (default=%(default)s)")
     draw_parser.add_argument("-filter", nargs=2, help='Filter data on specific key value pairs')
     draw_parser.add_argument("-options", default="download", choices=["download", "upload"],
                              help='Graph upload or download speeds. (default=%(default)s)')
+    draw_parser.add_argument("-view", default="series", choices=["series", "profile"],
+                             help="series draws every sample over time, profile draws a day of week by hour of day "
+                                  "heatmap of the median and 10th percentile. (default=%(default)s)")
+    draw_parser.add_argument("-sla", nargs=2, action="append", metavar=("METRIC", "LIMIT"),
+                             help="Shade where a metric breaches a limit. ie) -sla download 20 (can be repeated)")
+    draw_parser.add_argument("-group-by", dest="group_by", choices=SpeedCache.STRING_COLUMNS,
+                             help="Compare the series of every ssid, Provider, ip_address or probe and print "
+                                  "their statistics")
+    draw_parser.add_argument("-layout", default="overlay", choices=["overlay", "multiples"],
+                             help="Draw -group-by groups on one chart or one chart each. (default=%(default)s)")
+    draw_parser.add_argument("-summary", choices=["minute", "hour", "day", "month"],
+                             help="Print the tests, min, avg and max of -options per minute, hour, day or month "
+                                  "instead of drawing (summarized inside sqlite for a sqlite store)")
+
+    # create the parser for the "collect" command
+    collect_parser = subparsers.add_parser('collect', description="Collect results pushed by runners into one store.")
+    collect_parser.add_argument("-store", required=True, help="Sqlite store uri. ie) sqlite:///all-probes.db")
+    collect_parser.add_argument("-host", default="127.0.0.1", help="Address to listen on. (default=%(default)s)")
+    collect_parser.add_argument("-port", type=int, default=8080, help="Port to listen on. (default=%(default)s)")
+
+    # create the parser for the "compact" command
+    compact_parser = subparsers.add_parser('compact', description="Apply a retention policy to a store once.")
+    compact_parser.add_argument("-store", "-resultfile", dest="store", default="speedresults.json",
+                                help="Results file or store uri to compact. (default=%(default)s)")
+    add_retention_arguments(compact_parser)
+
+    # create the parser for the "import" command
+    import_parser = subparsers.add_parser('import', description="Copy a json results file into another store.")
+    import_parser.add_argument("-resultfile", default="speedresults.json",
+                               help="The json results file to import. (default=%(default)s)")
+    import_parser.add_argument("-store", required=True, help="Destination store uri. ie) sqlite:///speedresults.db")
     return parser.parse_args()
 
 
-def get_seconds(option):
+def add_retention_arguments(parser):
+    """Add the retention policy options shared by run and compact."""
+    parser.add_argument("-keep-raw", dest="keep_raw", type=int, metavar="DAYS",
+                        help="Replace results older than DAYS by hourly (see -aggregate) averages. (default=keep)")
+    parser.add_argument("-keep-info", dest="keep_info", type=int, metavar="DAYS",
+                        help="Drop the raw speedtest output of results older than DAYS. (default=keep)")
+    parser.add_argument("-aggregate", default="hour", choices=sorted(SpeedRetention.BUCKET_WIDTHS),
+                        help="What -keep-raw averages over. (default=%(default)s)")
+
+
+def get_retention(options):
     """
-    Get seconds from command line option.
+    Get the retention policy from command line options.
 
-    @param a command line option.
+    @param options the parsed command line options
+    @retval SpeedRetention.RetentionPolicy or None when everything is kept
+    """
+    if options.keep_raw is None and options.keep_info is None:
+        return None
+    try:
+        return SpeedRetention.RetentionPolicy(options.keep_raw, options.keep_info, options.aggregate)
+    except ValueError as e:
+        sys.exit("Error {0}".format(e))
+
+
+def get_sla(options):
+    """
+    Get the SLA limits from command line options.
+
+    Limits without a unit are in Mbit/s for speeds and ms for ping. ie) -sla download 500kbit/s
+
+    @param options the parsed command line options
+    @retval dictionary of metric to limit in bits/s or ms
+    """
+    sla = {}
+    for metric, limit in options.sla or []:
+        if metric not in OutageDetector.BAD_WHEN:
+            sys.exit("Error {0} is not a metric. Choose from {1}".format(metric, sorted(OutageDetector.BAD_WHEN)))
+        try:
+            if metric == "ping":
+                sla[metric] = SpeedParser.to_milliseconds(limit)
+            else:
+                sla[metric] = SpeedParser.to_bits_per_second(limit, default_unit="Mbit/s")
+        except SpeedParser.ParseError as e:
+            sys.exit("Error {0}".format(e))
+    return sla
+
+
+def parse_seconds(option):
+    """
+    Get seconds from a [number, unit] pair.
+
+    @param option ie) [5, "min"]
     @retval integer seconds
+    @throws ValueError when the unit is not accepted
     """
     sec_option = ["s", "sec", "secs"]
     min_option = ["m", "min", "mins"]
@@ -63,15 +182,87 @@ def get_seconds(option):
     elif option[1] in hr_option:
         return int(option[0]) * 3600
     elif option[1] in day_option:
-        return int(option[0]) * 216000
+        return int(option[0]) * 86400
     else:
-        sys.exit("Error {0} is not accepted".format(option[1]))
+        raise ValueError("{0} is not accepted".format(option[1]))
+
+
+def get_seconds(option):
+    """
+    Get seconds from command line option.
+
+    @param a command line option.
+    @retval integer seconds
+    """
+    try:
+        return parse_seconds(option)
+    except ValueError as e:
+        sys.exit("Error {0}".format(e))
+
+
+def get_scheduler(options, sec_delay, store):
+    """
+    Build the AdaptiveScheduler asked for on the command line.
+
+    @param options the parsed command line options
+    @param sec_delay seconds between tests
+    @param store the store earlier decisions of this month and the latest results are read from
+    @retval SpeedScheduler.AdaptiveScheduler or None when neither -adaptive nor a budget was given
+    """
+    if not (options.adaptive or options.budget_day or options.budget_month):
+        return None
+    try:
+        scheduler = SpeedScheduler.AdaptiveScheduler(
+            sec_delay,
+            min_delay=get_seconds(options.min_frequency) if options.min_frequency else None,
+            max_delay=get_seconds(options.max_frequency) if options.max_frequency else None,
+            adaptive=options.adaptive,
+            daily_budget=SpeedScheduler.parse_bytes(options.budget_day) if options.budget_day else None,
+            monthly_budget=SpeedScheduler.parse_bytes(options.budget_month) if options.budget_month else None)
+    except ValueError as e:
+        sys.exit("Error {0}".format(e))
+    scheduler.seed(store.events(kind="schedule", start=time.strftime("%Y-%m")))
+    if options.adaptive:
+        scheduler.seed_baseline(store.tail(SpeedScheduler.SEED_RESULTS))
+    return scheduler
+
+
+def load_config(configfile):
+    """
+    Read a runner config file.
+
+    The file is json, every key is optional.
+        {
+            "frequency": [5, "min"],
+            "duration": [24, "hour"]
+        }
+
+    @param configfile path to the config file
+    @retval dictionary with sec_delay and/or sec_to_run
+    @throws ValueError (or IOError) when the file cannot be used
+    """
+    with open(configfile) as f:
+        config = json.load(f)
+    settings = {}
+    if "frequency" in config:
+        settings["sec_delay"] = parse_seconds(config["frequency"])
+    if "duration" in config:
+        settings["sec_to_run"] = parse_seconds(config["duration"])
+    return settings
 
 
 class Runner(object):
-    """Used for proper teardown"""
+    """
+    Used for proper teardown.
+
+    The runner sleeps on an event so signals and control socket commands take effect right away.
+        SIGTERM, SIGINT     stop
+        SIGHUP              reload the config file
+        SIGUSR1             run a test now
+    """
 
-    def __init__(self, exec_num, sec_delay, sec_to_run, start_time, tester, logger, pidfile=None):
+    def __init__(self, exec_num, sec_delay, sec_to_run, start_time, tester, logger, pidfile=None,
+                 socket_path=None, configfile=None, scheduler=None, exporter=None, compactor=None):
         """
         Initialize Runner.
 
@@ -82,7 +273,12 @@ class Runner(object):
         @param tester
         @param logger a logger
         @param pidFile path to pid file (default:None)
-                       You can stop the runner by overwriting its pidfile
+                       It must be blank, the runner writes its pid to it and blanks it again on exit
+        @param socket_path path of a unix socket to accept RunnerControl commands on (default:None)
+        @param configfile path of a config file re-read on reload, see load_config (default:None)
+        @param scheduler SpeedScheduler.AdaptiveScheduler picking sec_delay after each test (default:None)
+        @param exporter SpeedExporter.PushExporter every result is also pushed with (default:None)
+        @param compactor SpeedRetention.Compactor applying a retention policy to the store (default:None)
         """
         super(Runner, self).__init__()
         self.exec_num = exec_num
@@ -92,8 +288,20 @@ class Runner(object):
         self.tester = tester
         self.logger = logger
         self.pidfile = pidfile
+        self.socket_path = socket_path
+        self.configfile = configfile
+        self.scheduler = scheduler
+        self.exporter = exporter
+        self.compactor = compactor
 
         self.owns_pid = False
+        self.control = None
+        self.state = "starting"
+        self.last_test_end = None
+        self.stop_requested = False
+        self.test_requested = False
+        self.wakeup = threading.Event()
+        self.closed = False
 
         # If we are instructed to use a process id file.
         if self.pidfile:
@@ -110,37 +318,161 @@ class Runner(object):
                 f.write(str(os.getpid()))
 
     def __del__(self):
-        """Clean PID file."""
+        """Clean up if close was never called."""
+        self.close()
+
+    def close(self):
+        """Flush results, stop the control socket and clean the PID file."""
+        if self.closed:
+            return
+        self.closed = True
         self.logger.info("Tearing down runner")
+        if self.compactor:
+            self.compactor.close()
+        self.tester.write_results_to_file(pretty=True)
+        self.tester.store.close()
+        if self.exporter:
+            self.exporter.close()
+        if self.control:
+            self.control.close()
         if self.pidfile and self.owns_pid:
             with open(self.pidfile, 'w') as f:
                 f.write("")
 
-    def we_should_stop(self):
-        """Return True if pidfile is declared and blank."""
-        if self.pidfile:
-            with open(self.pidfile, 'r') as f:
-                if f.read():
-                    return False  # The file has data
-                else:  # The file is declared but has no data
-                    return True
+    def request_stop(self):
+        """Stop after cancelling the test in progress, if any."""
+        self.logger.info("runner was told to stop")
+        self.stop_requested = True
+        self.tester.cancel()
+        self.wakeup.set()
+
+    def request_test(self):
+        """Run a test now."""
+        self.test_requested = True
+        self.wakeup.set()
+
+    def reload_config(self):
+        """
+        Re-read the config file and apply it.
+
+        @retval dictionary of the applied settings
+        @throws ValueError (or IOError) when there is no usable config file
+        """
+        if not self.configfile:
+            raise ValueError("runner was started without -configfile")
+        settings = load_config(self.configfile)
+        for key, val in settings.items():
+            setattr(self, key, val)
+        if self.scheduler and "sec_delay" in settings:
+            self.scheduler.reset(settings["sec_delay"])
+        self.logger.info("Reloaded {0}: {1}".format(self.configfile, settings))
+        # Wake up so the next test is scheduled with the new frequency
+        self.wakeup.set()
+        return settings
+
+    def status(self):
+        """Return what the runner is doing."""
+        status = {
+            "pid": os.getpid(),
+            "state": self.state,
+            "exec_num": self.exec_num,
+            "elapsed": time.time() - self.start_time,
+            "sec_delay": self.sec_delay,
+            "sec_to_run": self.sec_to_run,
+            "store": self.tester.results_file
+        }
+        if self.exporter:
+            status["push"] = self.exporter.status()
+        if self.state == "sleeping":
+            status["next_test_in"] = max(0.0, self.last_test_end + self.sec_delay - time.time())
+        return status
+
+    def handle_command(self, command):
+        """
+        Answer a RunnerControl command.
+
+        @param command one of RunnerControl.COMMANDS
+        @retval reply dictionary
+        """
+        if command == "stop":
+            self.request_stop()
+        elif command == "test":
+            self.request_test()
+        elif command == "reload":
+            try:
+                return {"ok": True, "settings": self.reload_config()}
+            except (ValueError, IOError, OSError) as e:
+                return {"ok": False, "error": str(e)}
+        return {"ok": True, "status": self.status()}
+
+    def on_signal(self, signum, frame):
+        """Handle SIGTERM, SIGINT, SIGHUP and SIGUSR1."""
+        if signum == getattr(signal, "SIGHUP", None):
+            try:
+                self.reload_config()
+            except (ValueError, IOError, OSError) as e:
+                self.logger.error("Could not reload config: {0}".format(e))
+        elif signum == getattr(signal, "SIGUSR1", None):
+            self.request_test()
         else:
-            return False  # The file is not declared
+            self.request_stop()
 
-    def run(self):
-        while True:
-            self.exec_num += 1
-            self.logger.info("Execution number {exec_num}.".format(exec_num=self.exec_num))
-            self.logger.info("Elapsed secs = {time}".format(time=time.time() - self.start_time))
-            self.tester.run_test()
-            self.tester.write_results_to_file(pretty=True)
-            if self.we_should_stop():
-                self.logger.info("runner was told to stop(pidfile blank)")
-                break
-            self.logger.info("Done. now sleeping for {sec} second(s)".format(sec=self.sec_delay))
-            time.sleep(self.sec_delay)
-            if time.time() - self.start_time > float(self.sec_to_run):
+    def install_signal_handlers(self):
+        """Route signals to on_signal, SIGHUP and SIGUSR1 only exist on nix."""
+        for name in ("SIGTERM", "SIGINT", "SIGHUP", "SIGUSR1"):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), self.on_signal)
+
+    def schedule(self, timestamp, result):
+        """Let the scheduler pick the delay after a test and save its decision to the store."""
+        self.sec_delay, decision = self.scheduler.next_delay(timestamp, result)
+        self.logger.info("Next test in {delay:.0f} second(s) ({reason}), {day_bytes} bytes used today".format(
+            **decision))
+        self.tester.store.append_event(decision)
+
+    def sleep(self):
+        """Wait for the next test, returning early when told to stop, to test now or once the duration is over."""
+        while not self.stop_requested and not self.test_requested:
+            remaining = min(self.last_test_end + self.sec_delay, self.start_time + float(self.sec_to_run)) - time.time()
+            if remaining <= 0:
                 break
+            self.wakeup.wait(remaining)
+            self.wakeup.clear()
+        self.test_requested = False
+
+    def run(self):
+        """Run tests until the duration is over or we are told to stop."""
+        self.install_signal_handlers()
+        if self.socket_path:
+            self.control = RunnerControl.ControlServer(self.socket_path, self.handle_command, self.logger)
+            self.control.start()
+        if self.compactor:
+            self.compactor.start()
+        try:
+            while not self.stop_requested:
+                self.exec_num += 1
+                self.logger.info("Execution number {exec_num}.".format(exec_num=self.exec_num))
+                self.logger.info("Elapsed secs = {time}".format(time=time.time() - self.start_time))
+                self.state = "testing"
+                last_result = self.tester.last_result
+                self.tester.run_test()
+                if self.tester.last_result is not last_result:
+                    if self.scheduler:
+                        self.schedule(*self.tester.last_result)
+                    if self.exporter:
+                        self.exporter.add(*self.tester.last_result)
+                self.tester.write_results_to_file(pretty=True)
+                self.last_test_end = time.time()
+                if self.stop_requested:
+                    break
+                self.logger.info("Done. now sleeping for {sec} second(s)".format(sec=self.sec_delay))
+                self.state = "sleeping"
+                self.sleep()
+                if time.time() - self.start_time >= float(self.sec_to_run):
+                    break
+        finally:
+            self.state = "stopping"
+            self.close()
 
 
 def main():
@@ -155,23 +487,93 @@ def main():
         logging.basicConfig(level=logging.INFO)                    # Create a logger
         logger = logging.getLogger(__name__)                       # Any logger should do
 
-        tester = SpeedTester.SpeedTester(logger, options.resultfile)
+        if options.socket and not RunnerControl.SUPPORTED:
+            sys.exit("-socket needs unix sockets, which this platform does not have. Stop the runner with a signal.")
+        detector = OutageDetector.DetectionEngine(OutageDetector.default_rules(get_sla(options)))
+        tester = SpeedTester.SpeedTester(logger, options.store, detector, options.format)
         try:
-            tester.get_previous_results()
-        except:
-            pass
-        runner = Runner(exec_num, sec_delay, sec_to_run, start_time, tester, logger, options.pidfile)
+            history = tester.store.tail(detector.history_size())
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Outage detection starts without earlier results, {0}".format(e))
+            history = []
+        detector.prime(history)
+        logger.info("Primed outage detection with {0} earlier result(s)".format(len(history)))
+        if options.configfile:
+            try:
+                settings = load_config(options.configfile)
+            except (ValueError, IOError, OSError) as e:
+                sys.exit("Error reading {0}: {1}".format(options.configfile, e))
+            sec_delay = settings.get("sec_delay", sec_delay)
+            sec_to_run = settings.get("sec_to_run", sec_to_run)
+        scheduler = get_scheduler(options, sec_delay, tester.store)
+        exporter = None
+        if options.push:
+            exporter = SpeedExporter.PushExporter(options.push, options.probe,
+                                                  options.spool or tester.store.sidecar_path("spool"), logger)
+        retention = get_retention(options)
+        compactor = SpeedRetention.Compactor(tester.store, retention, logger=logger) if retention else None
+        runner = Runner(exec_num, sec_delay, sec_to_run, start_time, tester, logger, options.pidfile,
+                        options.socket, options.configfile, scheduler, exporter, compactor)
         runner.run()
-    if options.command == "draw":
-        with open(options.resultfile) as f:
-            results = json.load(f)
+    if options.command == "draw" and options.summary:
+        store = SpeedStore.open_store(options.store)
+        filter_key, filter_value = options.filter or (None, None)
+        try:
+            rows = DrawSpeed.summarize(store, options.options, options.summary, options.start, options.end,
+                                       filter_key, filter_value)
+        except ValueError as e:
+            sys.exit("Error {0}".format(e))
+        finally:
+            store.close()
+        if not rows:
+            sys.exit("Error no results to summarize")
+        print("\n".join(DrawSpeed.format_summary(rows, "Mbit/s", DrawSpeed.MBIT)))
+    elif options.command == "draw" and options.view == "profile":
+        store = SpeedStore.open_store(options.store)
+        filter_key, filter_value = options.filter or (None, None)
+        profile = DrawSpeed.load_profile(store, options.options, options.start, options.end, filter_key, filter_value)
+        store.close()
+        for key in ("median", "p10"):
+            profile[key] = profile[key] / DrawSpeed.MBIT
+        if options.type == "pyplot":
+            d_speed = DrawSpeed.DrawWithPyPlot({})
+        else:
+            d_speed = DrawSpeed.DrawWithPlotly({})
+        d_speed.draw_profile(profile, options.options.capitalize(), "Mbit/s")
+    elif options.command == "draw" and options.group_by:
+        store = SpeedStore.open_store(options.store)
+        samples = SpeedCache.select_range(SpeedCache.load_samples(store), options.start, options.end)
+        store.close()
+        if options.filter:
+            samples = SpeedCache.filter_samples(samples, options.filter[0], options.filter[1])
+        names, grouped, starts, counts = DrawSpeed.split_groups(samples, options.group_by,
+                                                                ["timestamp", "error", options.options])
+        if not len(names):
+            sys.exit("Error no results to draw")
+        values = grouped[options.options] / DrawSpeed.MBIT
+        stats = DrawSpeed.group_stats(values, grouped["error"], starts, counts)
+        print("\n".join(DrawSpeed.format_group_stats(names, stats, "Mbit/s")))
         if options.type == "pyplot":
-            d_speed = DrawSpeed.DrawWithPyPlot(results)
-            if options.filter:
-                d_speed.speeddata = DrawSpeed.filter_data(d_speed.speeddata,
-                                                          options.filter[0],
-                                                          options.filter[1])
-            DrawSpeed.parse_data(d_speed, parsedays=True)
+            d_speed = DrawSpeed.DrawWithPyPlot({})
+            d_speed.draw_groups(names, SpeedCache.datetimes(grouped), values, starts, counts, stats,
+                                options.options.capitalize(), "Mbit/s", options.layout)
+        else:
+            d_speed = DrawSpeed.DrawWithPlotly({})
+            d_speed.draw_groups(names, grouped["timestamp"], values, starts, counts, stats,
+                                options.options.capitalize(), "Mbit/s", options.layout)
+    elif options.command == "draw":
+        store = SpeedStore.open_store(options.store)
+        samples = SpeedCache.select_range(SpeedCache.load_samples(store), options.start, options.end)
+        schedule = store.events(kind="schedule", start=options.start, end=options.end)
+        store.close()
+        if options.filter:
+            samples = SpeedCache.filter_samples(samples, options.filter[0], options.filter[1])
+        intervals = OutageDetector.detect_samples(samples, OutageDetector.default_rules(get_sla(options)))
+        if options.type == "pyplot":
+            d_speed = DrawSpeed.DrawWithPyPlot({})
+            DrawSpeed.parse_samples(d_speed, samples, parsedays=True)
+            d_speed.intervals = intervals
+            d_speed.schedule = schedule
             if options.options == "download":
                 d_speed.set_data({"name": "Download", "unit": "Mbit/s", "data": d_speed.download_speeds})
             elif options.options == "upload":
@@ -181,12 +583,10 @@ def main():
             d_speed.draw_data()  # Graph it!
         else:
             # Using the DrawWithPlotly Class
-            d_speed = DrawSpeed.DrawWithPlotly(results)
-            if options.filter:
-                d_speed.speeddata = DrawSpeed.filter_data(d_speed.speeddata,
-                                                          options.filter[0],
-                                                          options.filter[1])
-            DrawSpeed.parse_data(d_speed, parsedays=True)
+            d_speed = DrawSpeed.DrawWithPlotly({})
+            DrawSpeed.parse_samples(d_speed, samples, parsedays=True)
+            d_speed.intervals = intervals
+            d_speed.schedule = schedule
 
             # d_speed.set_data({"name": "Download", "unit": "Mbit/s", "data": d_speed.download_speeds})
             if options.options == "download":
@@ -196,6 +596,30 @@ def main():
             else:
                 d_speed.set_data(["download", "upload"])
             d_speed.draw_data()  # Graph it!
+    if options.command == "collect":
+        logging.basicConfig(level=logging.INFO)
+        try:
+            collector = SpeedCollector.SpeedCollector(options.store, options.host, options.port,
+                                                      logging.getLogger(__name__))
+        except ValueError as e:
+            sys.exit("Error {0}".format(e))
+        collector.serve_forever()
+    if options.command == "compact":
+        retention = get_retention(options)
+        if not retention:
+            sys.exit("Error nothing to do, give -keep-raw and/or -keep-info")
+        store = SpeedStore.open_store(options.store)
+        try:
+            stats = store.compact(retention)
+        except ValueError as e:
+            sys.exit("Error {0}".format(e))
+        store.close()
+        print("Compacted {aggregated} result(s) into {aggregates} aggregate(s), dropped all_info of {trimmed} "
+              "and {events} schedule event(s)".format(**stats))
+    if options.command == "import":
+        store = SpeedStore.open_store(options.store)
+        print("Imported {0} results into {1}".format(SpeedStore.import_json(options.resultfile, store), options.store))
+        store.close()
 
     return 1
 
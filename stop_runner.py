@@ -1,28 +1,39 @@
-"""Used to stop a process from a pidfile."""
+"""Used to stop a process from a pidfile or to send commands to a runner's control socket."""
 import os
 import argparse
+import json
 import signal
+import sys
+
+import RunnerControl
 
 
 def parse_cmd_line_options():
     """Option parser for stop_runner."""
     parser = argparse.ArgumentParser(prog='stop_runner.py',
-                                     description="Stop process from pid.",
-                                     epilog="Choose either pid or pidfile")
+                                     description="Stop process from pid or send a command to a runner's socket.",
+                                     epilog="Choose either pid, pidfile or socket")
     parser.add_argument("-pid")
     parser.add_argument("-pidfile")
+    parser.add_argument("-socket", help="The runner's -socket")
+    parser.add_argument("-command", default="stop", choices=RunnerControl.COMMANDS,
+                        help="Command to send to the socket. (default=%(default)s)")
     return parser.parse_args()
 
 
 def main():
-    """."""
+    """Send SIGTERM (the runner flushes its results and exits) or a socket command."""
     options = parse_cmd_line_options()
 
+    if options.socket:
+        if not RunnerControl.SUPPORTED:
+            sys.exit("-socket needs unix sockets, which this platform does not have. Use -pid or -pidfile.")
+        print(json.dumps(RunnerControl.send_command(options.socket, options.command), indent=4, sort_keys=True))
     if options.pidfile:
         with open(options.pidfile, 'r') as f:
             os.kill(int(f.read().strip()), signal.SIGTERM)
     if options.pid:
-        os.kill(options.pid, signal.SIGTERM)
+        os.kill(int(options.pid), signal.SIGTERM)
 
 if __name__ == '__main__':
     main()